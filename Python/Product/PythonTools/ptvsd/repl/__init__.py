@@ -50,8 +50,10 @@ except ImportError:
     new_module = types.ModuleType
 import traceback
 import random
+import binascii
 import os
 import inspect
+import weakref
 from collections import deque
 import ptvsd.util as _vspu
 
@@ -62,6 +64,7 @@ read_string = _vspu.read_string
 write_bytes = _vspu.write_bytes
 write_int = _vspu.write_int
 write_string = _vspu.write_string
+MessageBuilder = _vspu.MessageBuilder
 
 try:
     unicode
@@ -171,10 +174,23 @@ actual inspection and introspection."""
     _DONE = to_bytes('DONE')
     _MODC = to_bytes('MODC')
 
+    # stdout/stderr writes are buffered until this many characters are
+    # pending, they have been pending for this many seconds, or another
+    # message is sent to the interactive window.
+    output_flush_size = 16 * 1024
+    output_flush_delay = 0.05
+
     def __init__(self, *args, **kwargs):
         import threading
         self.conn = None
+        self.reader = None
         self.send_lock = SafeSendLock()
+        self._output_msg = None
+        self._output_key = None
+        self._output_parts = []
+        self._output_size = 0
+        self._output_event = threading.Event()
+        self._output_thread_started = False
         self.input_event = threading.Lock()
         self.input_event.acquire()  # lock starts acquired (we use it like a manual reset event)
         self.input_string = None
@@ -183,12 +199,14 @@ actual inspection and introspection."""
     def connect(self, port):
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect(('127.0.0.1', port))
+        self.reader = _vspu.SocketReader(self.conn)
 
         # start a new thread for communicating w/ the remote process
         start_new_thread(self._repl_loop, ())
 
     def connect_using_socket(self, socket):
         self.conn = socket
+        self.reader = _vspu.SocketReader(socket)
         start_new_thread(self._repl_loop, ())
 
     def _repl_loop(self):
@@ -210,7 +228,7 @@ actual inspection and introspection."""
                 else:
                     timeout_exc_types = socket.timeout
                 try:
-                    inp = read_bytes(self.conn, 4)
+                    inp = self.reader.read_bytes(4)
                 except timeout_exc_types: 
                     r, w, x = select.select([], [], [self.conn], 0)
                     if x:
@@ -219,7 +237,7 @@ actual inspection and introspection."""
                     continue
 
                 self.conn.settimeout(None)
-                if inp == '':
+                if not inp:
                     break
                 self.flush()
 
@@ -245,7 +263,7 @@ actual inspection and introspection."""
 
     def _cmd_run(self):
         """runs the received snippet of code"""
-        self.run_command(read_string(self.conn))
+        self.run_command(self.reader.read_string())
 
     def _cmd_abrt(self):
         """aborts the current running command"""
@@ -259,12 +277,11 @@ actual inspection and introspection."""
 
     def _cmd_mems(self):
         """gets the list of members available for the given expression"""
-        expression = read_string(self.conn)
+        expression = self.reader.read_string()
         try:
             resp = self.get_members(expression)
         except:
-            with self.send_lock:
-                write_bytes(self.conn, ReplBackend._MERR)
+            self._send(MessageBuilder(ReplBackend._MERR))
             _debug_write('error in eval')
             _debug_write(traceback.format_exc())
         else:
@@ -274,24 +291,22 @@ actual inspection and introspection."""
                 self._send_mres(*resp)
 
     def _send_mres(self, name, inst_members, type_members):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._MRES)
-            write_string(self.conn, name)
-            self._write_member_dict(inst_members)
-            self._write_member_dict(type_members)
+        msg = MessageBuilder(ReplBackend._MRES)
+        write_string(msg, name)
+        self._write_member_dict(msg, inst_members)
+        self._write_member_dict(msg, type_members)
+        self._send(msg)
 
     def _send_merr(self):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._MERR)
+        self._send(MessageBuilder(ReplBackend._MERR))
 
     def _cmd_sigs(self):
         """gets the signatures for the given expression"""
-        expression = read_string(self.conn)
+        expression = self.reader.read_string()
         try:
             resp = self.get_signatures(expression)
         except:
-            with self.send_lock:
-                write_bytes(self.conn, ReplBackend._SERR)
+            self._send(MessageBuilder(ReplBackend._SERR))
             _debug_write('error in eval')
             _debug_write(traceback.format_exc())
         else:
@@ -301,39 +316,38 @@ actual inspection and introspection."""
                 self._send_sres(resp)
 
     def _send_sres(self, sigs):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._SRES)
-            # single overload
-            write_int(self.conn, len(sigs))
-            for doc, args, vargs, varkw, defaults in sigs:
-                # write overload
-                write_string(self.conn, (doc or '')[:4096])
-                arg_count = len(args) + (vargs is not None) + (varkw is not None)
-                write_int(self.conn, arg_count)
-
-                def_values = [''] * (len(args) - len(defaults)) + ['=' + d for d in defaults]
-                for arg, def_value in zip(args, def_values):
-                    write_string(self.conn, (arg or '') + def_value)
-                if vargs is not None:
-                    write_string(self.conn, '*' + vargs)
-                if varkw is not None:
-                    write_string(self.conn, '**' + varkw)
+        msg = MessageBuilder(ReplBackend._SRES)
+        # single overload
+        write_int(msg, len(sigs))
+        for doc, args, vargs, varkw, defaults in sigs:
+            # write overload
+            write_string(msg, (doc or '')[:4096])
+            arg_count = len(args) + (vargs is not None) + (varkw is not None)
+            write_int(msg, arg_count)
+
+            def_values = [''] * (len(args) - len(defaults)) + ['=' + d for d in defaults]
+            for arg, def_value in zip(args, def_values):
+                write_string(msg, (arg or '') + def_value)
+            if vargs is not None:
+                write_string(msg, '*' + vargs)
+            if varkw is not None:
+                write_string(msg, '**' + varkw)
+        self._send(msg)
 
     def _send_serr(self):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._SERR)
+        self._send(MessageBuilder(ReplBackend._SERR))
 
     def _cmd_setm(self):
         global exec_mod
         """sets the current module which code will execute against"""
-        mod_name = read_string(self.conn)
+        mod_name = self.reader.read_string()
         self.set_current_module(mod_name)
 
     def _cmd_sett(self):
         """sets the current thread and frame which code will execute against"""
-        thread_id = read_int(self.conn)
-        frame_id = read_int(self.conn)
-        frame_kind = read_int(self.conn)
+        thread_id = self.reader.read_int()
+        frame_id = self.reader.read_int()
+        frame_kind = self.reader.read_int()
         self.set_current_thread_and_frame(thread_id, frame_id, frame_kind)
 
     def _cmd_mods(self):
@@ -344,29 +358,29 @@ actual inspection and introspection."""
         except:
             res = []
 
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._MODS)
-            write_int(self.conn, len(res))
-            for name, filename in res:
-                write_string(self.conn, name)
-                write_string(self.conn, filename)
+        msg = MessageBuilder(ReplBackend._MODS)
+        write_int(msg, len(res))
+        for name, filename in res:
+            write_string(msg, name)
+            write_string(msg, filename)
+        self._send(msg)
 
     def _cmd_inpl(self):
         """handles the input command which returns a string of input"""
-        self.input_string = read_string(self.conn)
+        self.input_string = self.reader.read_string()
         self.input_event.release()
 
     def _cmd_excf(self):
         """handles executing a single file"""
-        filename = read_string(self.conn)
-        args = read_string(self.conn)
+        filename = self.reader.read_string()
+        args = self.reader.read_string()
         self.execute_file(filename, args)
 
     def _cmd_excx(self):
         """handles executing a single file, module or process"""
-        filetype = read_string(self.conn)
-        filename = read_string(self.conn)
-        args = read_string(self.conn)
+        filetype = self.reader.read_string()
+        filename = self.reader.read_string()
+        args = self.reader.read_string()
         self.execute_file_ex(filetype, filename, args)
 
     _COMMANDS = {
@@ -383,11 +397,83 @@ actual inspection and introspection."""
         to_bytes('excx'): _cmd_excx,
     }
 
-    def _write_member_dict(self, mem_dict):
-        write_int(self.conn, len(mem_dict))
+    def _write_member_dict(self, msg, mem_dict):
+        write_int(msg, len(mem_dict))
         for name, type_name in mem_dict.items():
-            write_string(self.conn, name)
-            write_string(self.conn, type_name)
+            write_string(msg, name)
+            write_string(msg, type_name)
+
+    def _send(self, msg):
+        """sends a message accumulated in a MessageBuilder with a single write,
+        preceded by any buffered output"""
+        with self.send_lock:
+            if self._output_size:
+                pending = self._take_output()
+                pending.sendall(msg.buffer)
+                msg = pending
+            msg.send(self.conn)
+
+    def _end_output_run(self):
+        """encodes the buffered writes to the current stream as one message.
+        Must be called with send_lock held."""
+        if self._output_parts:
+            if self._output_msg is None:
+                self._output_msg = MessageBuilder()
+            write_bytes(self._output_msg, self._output_key[0])
+            write_string(self._output_msg, self._output_key[1]().join(self._output_parts))
+            self._output_parts = []
+        self._output_key = None
+
+    def _take_output(self):
+        """returns the buffered output as a MessageBuilder and resets the
+        buffer. Must be called with send_lock held."""
+        self._end_output_run()
+        msg = self._output_msg
+        self._output_msg = None
+        self._output_size = 0
+        return msg
+
+    def _write_output(self, cmd, value):
+        if not value:
+            return
+        with self.send_lock:
+            # consecutive writes of the same kind to the same stream are
+            # joined into a single message
+            key = cmd, type(value)
+            if key != self._output_key:
+                self._end_output_run()
+                self._output_key = key
+            self._output_parts.append(value)
+            was_empty = not self._output_size
+            self._output_size += len(value)
+            if self._output_size >= self.output_flush_size:
+                self._take_output().send(self.conn)
+                return
+
+        if was_empty:
+            if not self._output_thread_started:
+                self._output_thread_started = True
+                start_new_thread(self._output_flush_thread, ())
+            self._output_event.set()
+
+    def _output_flush_thread(self):
+        """sends buffered output once it has been pending for
+        output_flush_delay seconds"""
+        try:
+            while True:
+                self._output_event.wait()
+                self._output_event.clear()
+                time.sleep(self.output_flush_delay)
+                self.flush_output()
+        except:
+            _debug_write('error in output flush thread')
+            _debug_write(traceback.format_exc())
+
+    def flush_output(self):
+        """sends any buffered stdout/stderr output to the interactive window"""
+        with self.send_lock:
+            if self._output_size:
+                self._take_output().send(self.conn)
 
     def init_debugger(self):
         from os import path
@@ -399,72 +485,93 @@ actual inspection and introspection."""
         ptvsd.debugger.intercept_threads(True)
 
     def send_image(self, filename):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._IMGD)
-            write_string(self.conn, filename)
+        msg = MessageBuilder(ReplBackend._IMGD)
+        write_string(msg, filename)
+        self._send(msg)
 
     def write_png(self, image_bytes):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._DPNG)
-            write_int(self.conn, len(image_bytes))
-            write_bytes(self.conn, image_bytes)
+        msg = MessageBuilder(ReplBackend._DPNG)
+        write_int(msg, len(image_bytes))
+        write_bytes(msg, image_bytes)
+        self._send(msg)
 
     def write_xaml(self, xaml_bytes):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._DXAM)
-            write_int(self.conn, len(xaml_bytes))
-            write_bytes(self.conn, xaml_bytes)
+        msg = MessageBuilder(ReplBackend._DXAM)
+        write_int(msg, len(xaml_bytes))
+        write_bytes(msg, xaml_bytes)
+        self._send(msg)
+
+    def write_png_base64(self, data):
+        """displays a base64 encoded PNG image in the interactive window"""
+        self._send(self._decode_base64_message(ReplBackend._DPNG, data))
+
+    def write_xaml_base64(self, data):
+        """displays base64 encoded XAML in the interactive window"""
+        self._send(self._decode_base64_message(ReplBackend._DXAM, data))
+
+    # number of base64 characters decoded at a time, must be a multiple of 4
+    base64_chunk_size = 64 * 1024
+
+    def _decode_base64_message(self, cmd, data):
+        """decodes base64 data in chunks straight into a length-prefixed
+        message, without materializing the decoded image separately"""
+        if isinstance(data, unicode):
+            data = data.encode('ascii')
+        if to_bytes('\n') in data:
+            # line breaks would misalign the chunks
+            data = data.replace(to_bytes('\r'), to_bytes('')).replace(to_bytes('\n'), to_bytes(''))
+
+        msg = MessageBuilder(cmd)
+        start = len(msg.buffer)
+        write_int(msg, 0)
+        view = data if sys.platform == 'cli' else memoryview(data)
+        chunk = self.base64_chunk_size
+        for offset in range(0, len(data), chunk):
+            msg.buffer += binascii.a2b_base64(view[offset:offset + chunk])
+        struct.pack_into('!q', msg.buffer, start, len(msg.buffer) - start - 8)
+        return msg
 
     def send_prompt(self, ps1, ps2, allow_multiple_statements):
         """sends the current prompt to the interactive window"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._PRPC)
-            write_string(self.conn, ps1)
-            write_string(self.conn, ps2)
-            write_int(self.conn, 1 if allow_multiple_statements else 0)
+        msg = MessageBuilder(ReplBackend._PRPC)
+        write_string(msg, ps1)
+        write_string(msg, ps2)
+        write_int(msg, 1 if allow_multiple_statements else 0)
+        self._send(msg)
 
     def send_cwd(self):
         """sends the current working directory"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._CHWD)
-            write_string(self.conn, os.getcwd())
+        msg = MessageBuilder(ReplBackend._CHWD)
+        write_string(msg, os.getcwd())
+        self._send(msg)
 
     def send_error(self):
         """reports that an error occurred to the interactive window"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._ERRE)
+        self._send(MessageBuilder(ReplBackend._ERRE))
 
     def send_exit(self):
         """reports the that the REPL process has exited to the interactive window"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._EXIT)
+        self._send(MessageBuilder(ReplBackend._EXIT))
 
     def send_command_executed(self):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._DONE)
+        self._send(MessageBuilder(ReplBackend._DONE))
 
     def send_modules_changed(self):
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._MODC)
+        self._send(MessageBuilder(ReplBackend._MODC))
 
     def read_line(self):    
         """reads a line of input from standard input"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._RDLN)
+        self._send(MessageBuilder(ReplBackend._RDLN))
         self.input_event.acquire()
         return self.input_string
 
     def write_stdout(self, value):
         """writes a string to standard output in the remote console"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._STDO)
-            write_string(self.conn, value)
+        self._write_output(ReplBackend._STDO, value)
 
     def write_stderr(self, value):
         """writes a string to standard input in the remote console"""
-        with self.send_lock:
-            write_bytes(self.conn, ReplBackend._STDE)
-            write_string(self.conn, value)
+        self._write_output(ReplBackend._STDE, value)
 
     ################################################################
     # Implementation of execution, etc...
@@ -552,6 +659,76 @@ class _OldClass:
 _OldClassType = type(_OldClass)
 _OldInstanceType = type(_OldClass())
 
+# Py_TPFLAGS_HEAPTYPE is set on classes created by class statements. Only
+# these can be modified after creation; builtin and extension types cannot.
+_HEAPTYPE = 1 << 9
+
+def _snapshot_type(mro):
+    """returns what _is_type_unchanged needs to tell whether any class in mro
+    has been modified since.
+
+    Ids are stored rather than the classes and values, which would keep the
+    type alive through its own cache entry. The id of each value's type is
+    stored too, so a value that reuses a freed id is only missed when it is
+    of the same type and so has the same type name."""
+    classes = []
+    for i, c in enumerate(mro):
+        if getattr(c, '__flags__', _HEAPTYPE) & _HEAPTYPE:
+            d = c.__dict__
+            values = list(d.values())
+            classes.append((
+                i,
+                tuple(d),
+                tuple(map(id, values)),
+                tuple(map(id, map(type, values))),
+            ))
+    return tuple(map(id, mro)), classes
+
+def _is_type_unchanged(mro, snapshot):
+    mro_ids, classes = snapshot
+    if tuple(map(id, mro)) != mro_ids:
+        return False
+    for i, names, value_ids, type_ids in classes:
+        d = mro[i].__dict__
+        if len(d) != len(names):
+            return False
+        values = list(d.values())
+        if (tuple(map(id, values)) != value_ids or
+            tuple(d) != names or
+            tuple(map(id, map(type, values))) != type_ids):
+            return False
+    return True
+
+_IMMUTABLE_TYPES = frozenset((
+    type(None), bool, int, float, complex, str, bytes, type(u''), type(2**64),
+))
+
+def _is_immutable(value):
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(v) for v in value)
+    return type(value) in _IMMUTABLE_TYPES
+
+def _function_signature_state(func):
+    """returns the objects the signature of func is computed from, or None
+    if it cannot be cached: a default value could be modified in place and
+    so change its repr, and the signature of a wrapper comes from the
+    function it wraps."""
+    if hasattr(func, '__wrapped__'):
+        return None
+    defaults = func.__defaults__
+    kwdefaults = getattr(func, '__kwdefaults__', None) or {}
+    if not _is_immutable(defaults or ()):
+        return None
+    if not _is_immutable(tuple(kwdefaults.values())):
+        return None
+    # the keyword-only defaults are copied, as the dict can be modified
+    return (
+        func.__code__,
+        func.__doc__,
+        defaults,
+        getattr(func, '__signature__', None),
+    ) + tuple(kwdefaults) + tuple(kwdefaults.values())
+
 class BasicReplBackend(ReplBackend):
     future_bits = 0x3e010   # code flags used to mark future bits
 
@@ -576,6 +753,8 @@ class BasicReplBackend(ReplBackend):
         self.execute_item = None
         self.execute_item_lock = threading.Lock()
         self.execute_item_lock.acquire()    # lock starts acquired (we use it like manual reset event)
+        self.type_members_cache = weakref.WeakKeyDictionary()
+        self.signature_cache = weakref.WeakKeyDictionary()
 
     def init_connection(self):
         sys.stdout = _ReplOutput(self, is_stdout = True)
@@ -658,7 +837,7 @@ due to the exec, so we do it here"""
         # Otherwise we have a nested exception around and the 2nd abort doesn't
         # work (that's probably an IronPython bug)
         try:    
-            new_modules = get_cur_module_set()
+            new_modules = get_module_tracker().check()
             try:
                 if new_modules != cur_modules:
                     self.send_modules_changed()
@@ -740,7 +919,7 @@ due to the exec, so we do it here"""
             self.main_thread = System.Threading.Thread.CurrentThread
 
         # save ourselves so global lookups continue to work (required pre-2.6)...
-        cur_modules = set()
+        cur_modules = None
         try:
             cur_ps1 = sys.ps1
             cur_ps2 = sys.ps2
@@ -846,7 +1025,9 @@ due to the exec, so we do it here"""
                 getattr_func = code.Execute(self.exec_mod)
             else:
                 val = eval(expression, self.exec_mod.__dict__, self.exec_mod.__dict__)
-                members = dir(val)
+                # dir(val) is only needed when the type members cannot be
+                # served from the cache
+                members = None
 
         return self.collect_members(val, members, getattr_func)
 
@@ -866,7 +1047,20 @@ due to the exec, so we do it here"""
 
         # collect the type members
 
+        cached = None
+        if getattr_func is getattr:
+            cached = self._get_cached_type_members(val)
+
         type_members = {}
+        if cached is not None:
+            cached_members, uncached_names = cached
+            for mem_name, mem_t in cached_members.items():
+                if mem_name not in inst_members:
+                    type_members[mem_name] = mem_t
+            members = uncached_names
+        elif members is None:
+            members = dir(val)
+
         for mem_name in members:
             if mem_name not in inst_members:
                 mem_t = self._get_member_type(val, mem_name, False, getattr_func)
@@ -876,6 +1070,44 @@ due to the exec, so we do it here"""
 
         return t.__module__ + '.' + t.__name__, inst_members, type_members
 
+    def _get_cached_type_members(self, val):
+        """returns a dict of the members of type(val) mapped to their type names
+        and a list of the names that must be looked up on val itself, or None
+        if dir(val) cannot be derived from the type.
+
+        Entries are keyed by the type and are rebuilt when its MRO changes or
+        when a class dictionary in the MRO is modified."""
+        t = type(val)
+        try:
+            if (t is _OldInstanceType or
+                getattr(val, '__class__', None) is not t or
+                getattr(t, '__dir__', None) is not getattr(object, '__dir__', None)):
+                # dir() is customized, so we have to call it every time
+                return None
+            mro = t.__mro__
+            entry = self.type_members_cache.get(t)
+            if entry is not None and _is_type_unchanged(mro, entry[0]):
+                return entry[1], entry[2]
+            snapshot = _snapshot_type(mro)
+        except Exception:
+            return None
+
+        type_members = {}
+        uncached_names = []
+        for mem_name in dir(t):
+            try:
+                mem_t = BasicReplBackend.get_type_name(getattr(t, mem_name))
+            except Exception:
+                uncached_names.append(mem_name)
+            else:
+                if mem_t is not None:
+                    type_members[mem_name] = mem_t
+        try:
+            self.type_members_cache[t] = snapshot, type_members, uncached_names
+        except Exception:  # nosec B110
+            pass  # nosec B110 - types that cannot be weakly referenced are not cached.
+        return type_members, uncached_names
+
     def get_ipy_sig(self, obj, ctor):
         args = []
         vargs = None
@@ -903,7 +1135,75 @@ due to the exec, so we do it here"""
 
         return self.collect_signatures(val)
 
+    # number of callables whose signatures are remembered by collect_signatures
     def collect_signatures(self, val):
+        # Only Python functions are cached: everything their signature
+        # depends on can be checked cheaply, and they can be weakly
+        # referenced so the cache does not keep them alive. Bound methods
+        # are created on every evaluation, so they use their function's entry.
+        func = val
+        bound = False
+        if type(val) is types.MethodType:
+            func = val.__func__
+            bound = val.__self__ is not None
+        if type(func) is not types.FunctionType:
+            return self._collect_signatures(val)
+
+        state = _function_signature_state(func)
+        if state is None:
+            return self._collect_signatures(val)
+
+        entries = self.signature_cache.get(func)
+        if entries is None:
+            entries = self.signature_cache[func] = {}
+        entry = entries.get(bound)
+        if entry is not None and len(entry[0]) == len(state) and all(
+            x is y for x, y in zip(entry[0], state)
+        ):
+            return entry[1]
+
+        res = self._collect_signatures(val)
+        entries[bound] = state, res
+        return res
+
+    def _collect_signatures(self, val):
+        if sys.platform == 'cli' or not hasattr(inspect, 'signature'):
+            return self._collect_argspec_signatures(val)
+
+        # inspect.signature handles keyword-only arguments, uses
+        # __text_signature__ for builtins and omits self for bound methods
+        # and classes
+        doc = val.__doc__
+        sig = inspect.signature(val)
+        args = []
+        star = False
+        positional_only = False
+        for param in sig.parameters.values():
+            if positional_only and param.kind != param.POSITIONAL_ONLY:
+                # a / marks the preceding parameters as positional-only, as in
+                # def f(a, /, b)
+                args.append('/')
+                positional_only = False
+            if param.kind == param.POSITIONAL_ONLY:
+                positional_only = True
+            if param.kind == param.KEYWORD_ONLY and not star:
+                # a bare * marks the rest as keyword-only, as in def f(a, *, b)
+                args.append('*')
+                star = True
+            if param.kind == param.VAR_POSITIONAL:
+                args.append('*' + param.name)
+                star = True
+            elif param.kind == param.VAR_KEYWORD:
+                args.append('**' + param.name)
+            elif param.default is not param.empty:
+                args.append(param.name + '=' + repr(param.default))
+            else:
+                args.append(param.name)
+        if positional_only:
+            args.append('/')
+        return [(doc, args, None, None, [])]
+
+    def _collect_argspec_signatures(self, val):
         doc = val.__doc__
         type_obj = None
         if isinstance(val, type) or isinstance(val, _OldClassType):
@@ -1000,23 +1300,89 @@ def get_cur_module_set():
                 pass
         return res
 
-def get_module_names():
-    res = []
-    for name, module in sys.modules.items():
-        try:
-            if name != 'ptvsd' and not name.startswith('ptvsd.'):
-                if sys.platform == 'cli' and type(module) is NamespaceType:
-                    get_namespaces(name, module, res)
-                else:
-                    try:
-                        filename = os.path.abspath(module.__file__)
-                    except Exception:
-                        filename = None
-                    res.append((name, filename))
+class ModuleTracker(object):
+    """detects changes to sys.modules without copying it on every command.
 
+    Imports of modules that are not yet loaded are counted by this object,
+    which sits at the front of sys.meta_path and never finds anything itself.
+    Removals show up as a change in the length of sys.modules."""
+    def __init__(self):
+        self.version = 0
+        self.imports = 0
+        self._last_state = None
+        self._names = None
+        self._names_version = None
+        self._filenames = {}
+
+    def install(self):
+        try:
+            sys.meta_path.insert(0, self)
         except:  # nosec B110
-            pass
-    return res
+            pass  # nosec B110 - without the hook only length changes are detected.
+
+    def find_spec(self, fullname, path=None, target=None):
+        self.imports += 1
+        return None
+
+    def find_module(self, fullname, path=None):
+        self.imports += 1
+        return None
+
+    def check(self):
+        """returns the current version, which changes whenever a module has
+        been imported or removed since the previous check"""
+        state = self.imports, len(sys.modules)
+        if state != self._last_state:
+            self._last_state = state
+            self.version += 1
+        return self.version
+
+    def get_module_names(self):
+        """returns a sorted list of (name, filename) tuples, rebuilding it only
+        when the module set has changed"""
+        version = self.check()
+        if self._names_version != version:
+            self._names = self._collect_module_names()
+            self._names_version = version
+        return self._names
+
+    def _collect_module_names(self):
+        res = []
+        filenames = {}
+        for name, module in list(sys.modules.items()):
+            try:
+                if name != 'ptvsd' and not name.startswith('ptvsd.'):
+                    if sys.platform == 'cli' and type(module) is NamespaceType:
+                        get_namespaces(name, module, res)
+                    else:
+                        cached = self._filenames.get(name)
+                        if cached is not None and cached[0] is module:
+                            filename = cached[1]
+                        else:
+                            try:
+                                filename = os.path.abspath(module.__file__)
+                            except Exception:
+                                filename = None
+                        filenames[name] = module, filename
+                        res.append((name, filename))
+
+            except:  # nosec B110
+                pass
+        self._filenames = filenames
+        res.sort()
+        return res
+
+_MODULE_TRACKER = None
+
+def get_module_tracker():
+    global _MODULE_TRACKER
+    if _MODULE_TRACKER is None:
+        _MODULE_TRACKER = ModuleTracker()
+        _MODULE_TRACKER.install()
+    return _MODULE_TRACKER
+
+def get_module_names():
+    return list(get_module_tracker().get_module_names())
 
 def get_namespaces(basename, namespace, names):
     names.append((basename, ''))
@@ -1199,6 +1565,7 @@ class _ReplOutput(object):
         self.pipe = None
 
     def flush(self):
+        self.backend.flush_output()
         if self.old_out:
             self.old_out.flush()
 
@@ -1209,17 +1576,34 @@ class _ReplOutput(object):
 
         return self.pipe[1]
 
+    pipe_read_size = 64 * 1024
+
     def pipe_thread(self):
+        import codecs
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        pending_cr = False
         while True:
-            data = os.read(self.pipe[0], 1)
-            if data == '\r':
-                data = os.read(self.pipe[0], 1)
-                if data == '\n':
-                    self.write('\n')
-                else:
-                    self.write('\r' + data)
+            # read whatever is available so a burst of native output is
+            # forwarded as a few large messages rather than one per byte
+            data = os.read(self.pipe[0], self.pipe_read_size)
+            if not data:
+                text = decoder.decode(data, True)
             else:
-                self.write(data)
+                text = decoder.decode(data)
+
+            if pending_cr:
+                text = '\r' + text
+                pending_cr = False
+            if data and text.endswith('\r'):
+                # the matching '\n' may arrive in the next block
+                text = text[:-1]
+                pending_cr = True
+
+            text = text.replace('\r\n', '\n')
+            if text:
+                self.write(text)
+            if not data:
+                break
 
     def writelines(self, lines):
         for line in lines:
@@ -1227,7 +1611,8 @@ class _ReplOutput(object):
             self.write('\n')
 
     def write(self, value):
-        _debug_write('printing ' + repr(value) + '\n')
+        if DEBUG:
+            _debug_write('printing ' + repr(value) + '\n')
         if self.is_stdout:
             self.backend.write_stdout(value)
         else:
@@ -28,11 +28,6 @@ try:
 except:
     import _thread as thread    # Renamed as Py3k
 
-try:
-    from base64 import decodestring
-except:
-    from base64 import decodebytes as decodestring # Deprecated in 3.9
-
 try:
     import IPython
 except ImportError:
@@ -186,9 +181,7 @@ class VsIOPubChannel(DefaultHandler, IOPubChannel):
         output_xaml = data.get('application/xaml+xml', None)
         if output_xaml is not None:
             try:
-                if isinstance(output_xaml, str) and sys.version_info[0] >= 3:
-                    output_xaml = output_xaml.encode('ascii')
-                self._vs_backend.write_xaml(str(decodestring(output_xaml)))
+                self._vs_backend.write_xaml_base64(output_xaml)
                 self._vs_backend.write_stdout('\n') 
                 return
             except:  # nosec B110
@@ -197,9 +190,7 @@ class VsIOPubChannel(DefaultHandler, IOPubChannel):
         output_png = data.get('image/png', None)
         if output_png is not None:
             try:
-                if isinstance(output_png, str) and sys.version_info[0] >= 3:
-                    output_png = output_png.encode('ascii')
-                self._vs_backend.write_png(str(decodestring(output_png)))
+                self._vs_backend.write_png_base64(output_png)
                 self._vs_backend.write_stdout('\n') 
                 return
             except:  # nosec B110
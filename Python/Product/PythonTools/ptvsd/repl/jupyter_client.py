@@ -22,16 +22,16 @@ __author__ = "Microsoft Corporation <ptvshelp@microsoft.com>"
 __version__ = "3.2.1.0"
 
 import ast
-import base64
 import errno
 import os
 import re
-import sys
 import threading
 import time
 import traceback
+from collections import deque
 from ptvsd.repl import BasicReplBackend, ReplBackend, UnsupportedReplException, _command_line_to_args_list, DEBUG
 from ptvsd.util import to_bytes
+from ptvsd.repl import jupyter_kernel_pool
 
 try:
     import jupyter_client
@@ -96,6 +96,8 @@ class IntrospectHandler(object):
         self.typename = None
         self.members = None
         self.responded = False
+        self.pending = None
+        self._lock = threading.Lock()
 
     def send(self, expression):
         if not expression:
@@ -115,15 +117,18 @@ class IntrospectHandler(object):
             self._on_reply.setdefault((msg_id, 'complete_reply'), []).append(self.complete_reply)
 
     def _respond(self, success):
-        if self.responded:
-            return
-        if not self.callback:
-            raise RuntimeError("No callback provider to message handler")
+        with self._lock:
+            if self.responded:
+                return
+            if not self.callback:
+                # the reply arrived before set_callback was called
+                self.pending = success
+                return
+            self.responded = True
         if success:
             self.callback(self.typename, self.members, {})
         else:
             self.error()
-        self.responded = True
 
     def complete_reply(self, message):
         if message.content.status != 'ok':
@@ -148,8 +153,12 @@ class IntrospectHandler(object):
             self._respond(True)
 
     def set_callback(self, success_callback, error_callback):
-        self.callback = success_callback
-        self.error = error_callback
+        with self._lock:
+            self.callback = success_callback
+            self.error = error_callback
+            pending = self.pending
+        if pending is not None:
+            self._respond(pending)
 
 class SignaturesHandler(object):
     def __init__(self, client, on_reply, suppress_io):
@@ -160,6 +169,8 @@ class SignaturesHandler(object):
         self.error = None
         self.signatures = None
         self.responded = False
+        self.pending = None
+        self._lock = threading.Lock()
 
     def send(self, expression):
         if not expression:
@@ -175,15 +186,18 @@ class SignaturesHandler(object):
         self._on_reply.setdefault((msg_id, 'execute_reply'), []).append(self.signatures_reply)
 
     def _respond(self, success):
-        if self.responded:
-            return
-        if not self.callback:
-            raise RuntimeError("No callback provider to message handler")
+        with self._lock:
+            if self.responded:
+                return
+            if not self.callback:
+                # the reply arrived before set_callback was called
+                self.pending = success
+                return
+            self.responded = True
         if success:
             self.callback(self.signatures)
         else:
             self.error()
-        self.responded = True
 
     def signatures_reply(self, message):
         if message.content.status != 'ok' or message.content.user_expressions.sigs.status != 'ok':
@@ -193,8 +207,12 @@ class SignaturesHandler(object):
         self._respond(True)
 
     def set_callback(self, success_callback, error_callback):
-        self.callback = success_callback
-        self.error = error_callback
+        with self._lock:
+            self.callback = success_callback
+            self.error = error_callback
+            pending = self.pending
+        if pending is not None:
+            self._respond(pending)
 
 EXEC_HELPERS_COMMAND = """#nohistory
 def __ptvs_repl_exec_helpers():
@@ -204,10 +222,25 @@ def __ptvs_repl_exec_helpers():
 __ptvs_repl_exec_helpers()
 """ % os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jupyter_client-helpers.py')
 
+CHDIR_COMMAND = """#nohistory
+import os as __ptvs_repl_os
+__ptvs_repl_os.chdir(%r)
+del __ptvs_repl_os
+"""
+
+class QueuedExecution(object):
+    """user code waiting to be sent to the kernel, which is cancelled if
+    the user aborts before it runs"""
+    def __init__(self, command, store_history=True):
+        self.command = command
+        self.store_history = store_history
+
 class JupyterClientBackend(ReplBackend):
     def __init__(self, mod_name='__main__', launch_file=None):
         super(JupyterClientBackend, self).__init__()
         self.__client = None
+        self.__km = None
+        self.__claim = None
 
         # This lock will be released when we should shut down
         self.__exit = threading.Lock()
@@ -215,10 +248,18 @@ class JupyterClientBackend(ReplBackend):
 
         self.__lock = threading.RLock()
         self.__status = 'idle'
+        # number of user executions sent to the kernel without a reply yet
+        self.__executing = 0
+        self.__interrupt_pending = False
         self.__msg_buffer = []
-        self.__cmd_buffer = [EXEC_HELPERS_COMMAND]
+        # Commands and requests are queued here and sent to the kernel from
+        # the I/O thread, which owns the client's sockets.
+        self.__cmd_buffer = deque([EXEC_HELPERS_COMMAND])
         self.__on_reply = {}
         self.__suppress_io = set()
+        self.__last_exec_count = None
+        self.__wake_send = None
+        self.__wake_recv = None
 
     def execution_loop(self):
         """starts processing execution requests"""
@@ -233,38 +274,127 @@ class JupyterClientBackend(ReplBackend):
                 input()
             raise
 
-    def _execution_loop(self):
+    def __start_kernel(self):
+        """returns (km, kc, claim), using a kernel from the pool when one is
+        enabled and ready"""
+        size = jupyter_kernel_pool.get_pool_size()
+        claim = None
+        if size:
+            try:
+                claim = jupyter_kernel_pool.claim_kernel(size)
+            except Exception:
+                traceback.print_exc()
+        if claim is not None:
+            kc = jupyter_client.BlockingKernelClient()
+            try:
+                kc.load_connection_info(claim.connection_info)
+                kc.start_channels()
+                kc.wait_for_ready(timeout=jupyter_kernel_pool.CLAIM_TIMEOUT)
+            except Exception:
+                traceback.print_exc()
+                kc.stop_channels()
+                claim.close()
+            else:
+                # The pool already ran the helpers, but the kernel started in
+                # the pool's working directory rather than ours.
+                self.__cmd_buffer.remove(EXEC_HELPERS_COMMAND)
+                self.__cmd_buffer.appendleft(CHDIR_COMMAND % os.getcwd())
+                return None, kc, claim
+
         km, kc = jupyter_client.manager.start_new_kernel()
+        return km, kc, None
+
+    def _execution_loop(self):
+        km, kc, claim = self.__start_kernel()
         try:
             self.exit_requested = False
+            self.__km = km
+            self.__claim = claim
             self.__client = kc
             self.send_cwd()
 
-            self.__shell_thread = _thread.start_new_thread(self.__shell_threadproc, (kc,))
-            self.__iopub_thread = _thread.start_new_thread(self.__iopub_threadproc, (kc,))
+            # An inproc socket pair lets other threads wake the I/O thread
+            # when they queue a command.
+            ctx = zmq.Context.instance()
+            addr = 'inproc://ptvs-repl-wake-%s' % id(self)
+            self.__wake_recv = ctx.socket(zmq.PAIR)
+            self.__wake_recv.bind(addr)
+            self.__wake_send = ctx.socket(zmq.PAIR)
+            self.__wake_send.connect(addr)
+
+            self.__io_thread = _thread.start_new_thread(self.__io_threadproc, (kc,))
 
             self.__exit.acquire()
 
             self.send_exit()
         finally:
             kc.stop_channels()
-            km.shutdown_kernel(now=True)
+            if claim is not None:
+                # the pool shuts the kernel down when the claim is closed
+                claim.close()
+            else:
+                km.shutdown_kernel(now=True)
 
     def __command_executed(self, msg):
+        self.__executing -= 1
+        if not self.__executing:
+            self.__interrupt_pending = False
         if msg.msg_type == 'execute_reply':
             self.__handle_payloads(msg.content['payload'])
 
         self.send_command_executed()
 
+    def __post(self, cmd, first=False):
+        """queues a command string, execution or callable for the I/O thread"""
+        with self.__lock:
+            if first:
+                self.__cmd_buffer.appendleft(cmd)
+            else:
+                self.__cmd_buffer.append(cmd)
+        self.__wake()
+
+    def __wake(self):
+        with self.__lock:
+            if self.__wake_send is not None:
+                try:
+                    self.__wake_send.send(to_bytes(''), zmq.NOBLOCK)
+                except zmq.Again:
+                    # the I/O thread already has a wakeup pending
+                    pass
+
     def run_command(self, command):
         """runs the specified command which is a string containing code"""
-        if self.__client:
-            with self.__lock:
-                self.__exec(command, store_history=True, silent=False).append(self.__command_executed)
-            return True
+        if command.startswith('#nohistory'):
+            self.__post(command)
+        else:
+            self.__post(QueuedExecution(command))
+        return self.__client is not None
+
+    def __run_queued(self):
+        while self.__cmd_buffer and not self.exit_requested:
+            cmd = self.__cmd_buffer.popleft()
+            if isinstance(cmd, QueuedExecution):
+                self.__executing += 1
+                self.__exec(
+                    cmd.command,
+                    store_history=cmd.store_history,
+                    silent=False,
+                ).append(self.__command_executed)
+            elif hasattr(cmd, '__call__'):
+                cmd()
+            else:
+                self.__exec(cmd)
 
-        self.__cmd_buffer.append(command)
-        return False
+    def __cancel_queued(self):
+        """drops user code that has not been sent to the kernel yet"""
+        with self.__lock:
+            queued = list(self.__cmd_buffer)
+            self.__cmd_buffer.clear()
+            self.__cmd_buffer.extend(cmd for cmd in queued if not isinstance(cmd, QueuedExecution))
+        for cmd in queued:
+            if isinstance(cmd, QueuedExecution):
+                # the window waits for each command it sent to complete
+                self.send_command_executed()
 
     def __exec(self, command, store_history=False, allow_stdin=False, silent=True, get_vars=None):
         with self.__lock:
@@ -283,35 +413,50 @@ class JupyterClientBackend(ReplBackend):
             command = "!%s %s" % (filename, args)
         else:
             command = "__ptvs_repl_exec_%s(%r, %r, globals(), locals())" % (filetype, filename, args)
-        if self.__client:
-            self.__exec(command, silent=False).append(self.__command_executed)
-            return True
-
-        self.__cmd_buffer.append(command)
-        return False
+        self.__post(QueuedExecution(command, store_history=False))
+        return self.__client is not None
 
     def interrupt_main(self):
         """aborts the current running command"""
-        #raise NotImplementedError
-        pass
+        # Queued commands are cancelled on the I/O thread, which is the only
+        # one that takes commands from the queue.
+        self.__post(self.__cancel_queued, first=True)
+
+        if not self.__executing:
+            return
+        with self.__lock:
+            # The kernel ignores interrupts while idle, so wait until it
+            # reports that it has started on the request.
+            self.__interrupt_pending = True
+            if self.__status == 'busy':
+                self.__interrupt_kernel()
+
+    def __interrupt_kernel(self):
+        self.__interrupt_pending = False
+        try:
+            if self.__claim is not None:
+                self.__claim.interrupt()
+            elif self.__km is not None:
+                self.__km.interrupt_kernel()
+        except Exception:
+            traceback.print_exc()
 
     def exit_process(self):
         """exits the REPL process"""
         self.exit_requested = True
         self.__exit.release()
+        self.__wake()
 
     def get_members(self, expression):
         handler = IntrospectHandler(self.__client, self.__on_reply, self.__suppress_io)
-        with self.__lock:
-            handler.send(expression)
-            return handler.set_callback
+        self.__post(lambda: handler.send(expression))
+        return handler.set_callback
 
     def get_signatures(self, expression):
         """returns doc, args, vargs, varkw, defaults."""
         handler = SignaturesHandler(self.__client, self.__on_reply, self.__suppress_io)
-        with self.__lock:
-            handler.send(expression)
-            return handler.set_callback
+        self.__post(lambda: handler.send(expression))
+        return handler.set_callback
 
     def set_current_module(self, module):
         """sets the module which code executes against"""
@@ -329,54 +474,41 @@ class JupyterClientBackend(ReplBackend):
         """flushes the stdout/stderr buffers"""
         pass
 
-    def __shell_threadproc(self, client):
+    def __io_threadproc(self, client):
         try:
-            last_exec_count = None
-            on_replies = self.__on_reply
+            shell = client.shell_channel.socket
+            iopub = client.iopub_channel.socket
+            wake = self.__wake_recv
+
+            # Wait on both kernel sockets and the wakeup socket together, so
+            # replies and queued commands are handled as soon as they arrive.
+            poller = zmq.Poller()
+            poller.register(iopub, zmq.POLLIN)
+            poller.register(shell, zmq.POLLIN)
+            poller.register(wake, zmq.POLLIN)
+
             while not self.exit_requested:
-                while self.__cmd_buffer and not self.exit_requested:
-                    cmd = self.__cmd_buffer.pop(0)
-                    if cmd.startswith('#nohistory'):
-                        self.__exec(cmd)
-                    else:
-                        self.run_command(cmd)
+                self.__run_queued()
                 if self.exit_requested:
                     break
 
-                try:
-                    # Replace 'block=True' with 'timeout=1.0' and handle Empty exception
-                    m = Message(client.get_shell_msg(timeout=0.1))
-                    msg_id = m.msg_id
-                    msg_type = m.msg_type
-
-                    print('%s: %s' % (msg_type, msg_id))
-
-                    exec_count = m.content['execution_count', None]
-                    if exec_count != last_exec_count and exec_count is not None:
-                        last_exec_count = exec_count
-                        exec_count = int(exec_count) + 1
-                        ps1 = 'In [%s]: ' % exec_count
-                        ps2 = ' ' * (len(ps1) - 5) + '...: '
-                        self.send_prompt('\n' + ps1, ps2, allow_multiple_statements=True)
-
-                    parent_id = m.parent_header['msg_id', None]
-                    if parent_id:
-                        on_reply = on_replies.pop((parent_id, msg_type), ())
-                        for callable in on_reply:
-                            callable(m)
-                except Empty:
-                    # No message received within the timeout
-                    continue
-                except zmq.Again:
-                    pass  # Handle timeout without hanging
-                except Exception as e:
-                    # Log unexpected errors during message retrieval
-                    print(f"Unexpected error in get_iopub_msg: {e}")
-                    traceback.print_exc()
-                    continue
+                ready = dict(poller.poll())
+                if wake in ready:
+                    while True:
+                        try:
+                            wake.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                # Output is handled first so it reaches the window before the
+                # reply that completes the command.
+                if iopub in ready:
+                    self.__drain(client.get_iopub_msg, self.__handle_iopub_msg)
+                if shell in ready:
+                    self.__drain(client.get_shell_msg, self.__handle_shell_msg)
         except zmq.error.ZMQError as e:
-            print(f"ZMQError encountered: {e}")
-            self.exit_process()
+            if not self.exit_requested:
+                print(f"ZMQError encountered: {e}")
+                self.exit_process()
         except KeyboardInterrupt:
             print("KeyboardInterrupt detected, exiting process.")
             self.exit_process()
@@ -390,55 +522,69 @@ class JupyterClientBackend(ReplBackend):
                 input()
             self.exit_process()
 
-    def __iopub_threadproc(self, client):
-        try:
-            last_exec_count = None
-            while not self.exit_requested:
-                try:
-                    # Replace 'block=True' with 'timeout=1.0'
-                    m = Message(client.get_iopub_msg(timeout=1.0))  # Timeout in seconds
-
-                    if m.parent_header.msg_id in self.__suppress_io:
-                        if m.msg_type != 'status':
-                            self.__suppress_io.discard(m.parent_header.msg_id)
-                        continue
-
-                    if m.msg_type == 'execute_input':
-                        pass
-                    elif m.msg_type == 'execute_result':
-                        self.__write_result(m.content)
-                    elif m.msg_type == 'display_data':
-                        self.__write_content(m.content)
-                    elif m.msg_type == 'stream':
-                        self.__write_stream(m.content)
-                    elif m.msg_type == 'error':
-                        self.__write_result(m.content, treat_as_error=True)
-                    elif m.msg_type == 'status':
-                        self.__status = m.content['execution_state', 'idle']
-                    else:
-                        print("Received: " + m.msg_type + ":" + str(m) + "\n")
-                        self.write_stdout(str(m) + '\n')
-                except Empty:
-                    # No message received within the timeout, continue loop
-                    continue
-                except Exception as e:
-                    # Log unexpected errors during message retrieval
-                    print(f"Unexpected error in get_iopub_msg: {e}")
-                    traceback.print_exc()
-                    continue
-
-        except zmq.error.ZMQError:
-            self.exit_process()
-        except KeyboardInterrupt:
-            self.exit_process()
-        except:
-            # TODO: Better fatal error handling
-            traceback.print_exc()
+    def __drain(self, get_msg, handle_msg):
+        """handles every message that is already available on a channel"""
+        while not self.exit_requested:
             try:
-                raw_input()
-            except NameError:
-                input()
-            self.exit_process()
+                m = Message(get_msg(timeout=0))
+            except Empty:
+                return
+            try:
+                handle_msg(m)
+            except zmq.error.ZMQError:
+                raise
+            except Exception as e:
+                # Log unexpected errors while handling the message
+                print(f"Unexpected error handling {m.msg_type}: {e}")
+                traceback.print_exc()
+
+    def __handle_shell_msg(self, m):
+        msg_type = m.msg_type
+        if DEBUG:
+            print('%s: %s' % (msg_type, m.msg_id))
+
+        exec_count = m.content['execution_count', None]
+        if exec_count != self.__last_exec_count and exec_count is not None:
+            self.__last_exec_count = exec_count
+            exec_count = int(exec_count) + 1
+            ps1 = 'In [%s]: ' % exec_count
+            ps2 = ' ' * (len(ps1) - 5) + '...: '
+            self.send_prompt('\n' + ps1, ps2, allow_multiple_statements=True)
+
+        parent_id = m.parent_header['msg_id', None]
+        if parent_id:
+            on_reply = self.__on_reply.pop((parent_id, msg_type), ())
+            for callable in on_reply:
+                callable(m)
+
+    def __handle_iopub_msg(self, m):
+        parent_id = m.parent_header.msg_id
+        if parent_id in self.__suppress_io:
+            if m.msg_type == 'status' and m.content['execution_state', None] == 'idle':
+                # the kernel has finished the request, so no more output
+                # will arrive for it
+                self.__suppress_io.discard(parent_id)
+            return
+
+        if m.msg_type == 'execute_input':
+            pass
+        elif m.msg_type == 'execute_result':
+            self.__write_result(m.content)
+        elif m.msg_type == 'display_data':
+            self.__write_content(m.content)
+        elif m.msg_type == 'stream':
+            self.__write_stream(m.content)
+        elif m.msg_type == 'error':
+            self.__write_result(m.content, treat_as_error=True)
+        elif m.msg_type == 'status':
+            with self.__lock:
+                self.__status = m.content['execution_state', 'idle']
+                if self.__status == 'busy' and self.__interrupt_pending:
+                    self.__interrupt_kernel()
+        else:
+            if DEBUG:
+                print("Received: " + m.msg_type + ":" + str(m) + "\n")
+            self.write_stdout(str(m) + '\n')
 
     def __write_stream(self, content):
         if content.name == 'stderr':
@@ -491,9 +637,7 @@ class JupyterClientBackend(ReplBackend):
         output_xaml = content.data['application/xaml+xml']
         if output_xaml is not None:
             try:
-                if isinstance(output_xaml, str) and sys.version_info[0] >= 3:
-                    output_xaml = output_xaml.encode('ascii')
-                self.write_xaml(base64.decodestring(output_xaml))
+                self.write_xaml_base64(output_xaml)
                 self.write_stdout('\n')
                 return
             except Exception:
@@ -503,9 +647,7 @@ class JupyterClientBackend(ReplBackend):
         output_png = content.data['image/png', None]
         if output_png is not None:
             try:
-                if isinstance(output_png, str) and sys.version_info[0] >= 3:
-                    output_png = output_png.encode('ascii')
-                self.write_png(base64.decodestring(output_png))
+                self.write_png_base64(output_png)
                 self.write_stdout('\n')
                 return
             except Exception:
@@ -0,0 +1,469 @@
+# Python Tools for Visual Studio
+# Copyright(c) Microsoft Corporation
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the License); you may not use
+# this file except in compliance with the License. You may obtain a copy of the
+# License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# THIS CODE IS PROVIDED ON AN  *AS IS* BASIS, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, EITHER EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION ANY
+# IMPLIED WARRANTIES OR CONDITIONS OF TITLE, FITNESS FOR A PARTICULAR PURPOSE,
+# MERCHANTABILITY OR NON-INFRINGEMENT.
+#
+# See the Apache Version 2.0 License for specific language governing
+# permissions and limitations under the License.
+
+"""Keeps initialized Jupyter kernels ready for the Jupyter REPL backend.
+
+When PTVS_JUPYTER_KERNEL_POOL is set to a pool size, the REPL claims a kernel
+from a background pool process instead of starting one itself. The pool keeps
+that many kernels running with the REPL helpers already executed, so opening
+or resetting the interactive window does not wait for a kernel to boot.
+
+The pool is private to one interpreter, kernel spec and the environment
+variables that affect them, such as PYTHONPATH. Other variables are those of
+the REPL that started the pool. It listens on a
+loopback socket whose port and access token are stored in a user-only file in
+the Jupyter runtime directory. A claimed kernel belongs to the REPL for as
+long as its connection to the pool stays open, and is shut down when that
+connection closes. The REPL interrupts its kernel through the same
+connection, since only the pool can signal the kernel process. Ready kernels
+are replaced after --max-age seconds, and the pool exits after --idle-timeout
+seconds without any connected REPL.
+"""
+
+from __future__ import absolute_import, print_function
+
+__author__ = "Microsoft Corporation <ptvshelp@microsoft.com>"
+__version__ = "3.2.1.0"
+
+import hashlib
+import hmac
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+
+POOL_SIZE_ENV = 'PTVS_JUPYTER_KERNEL_POOL'
+
+# Seconds the REPL waits for the pool before starting its own kernel
+CLAIM_TIMEOUT = 2.0
+
+# Ready kernels older than this are restarted, so packages installed or
+# changed since they started are picked up
+DEFAULT_MAX_AGE = 30 * 60
+
+# The pool exits once no REPL has been connected for this long
+DEFAULT_IDLE_TIMEOUT = 60 * 60
+
+KERNEL_STARTUP_TIMEOUT = 60
+
+def get_pool_size():
+    """returns the configured pool size, or 0 if the pool is disabled"""
+    try:
+        return max(0, int(os.environ.get(POOL_SIZE_ENV, '0')))
+    except ValueError:
+        return 0
+
+# Environment variables that change which kernel is started or what it imports
+KERNEL_ENVIRONMENT = (
+    'PATH', 'PYTHONPATH', 'PYTHONHOME', 'VIRTUAL_ENV', 'CONDA_PREFIX',
+    'JUPYTER_PATH', 'JUPYTER_CONFIG_DIR', 'JUPYTER_DATA_DIR',
+)
+
+def _kernel_spec_parts():
+    """returns the parts of the default kernel spec that the started kernel
+    depends on"""
+    from jupyter_client.kernelspec import KernelSpecManager, NATIVE_KERNEL_NAME
+
+    try:
+        spec = KernelSpecManager().get_kernel_spec(NATIVE_KERNEL_NAME)
+    except Exception:
+        return []
+    return [spec.resource_dir, json.dumps([spec.argv, spec.env], sort_keys=True)]
+
+def _state_file():
+    """returns the state file for a pool serving this interpreter, kernel
+    spec and environment"""
+    from jupyter_core.paths import jupyter_runtime_dir
+
+    h = hashlib.sha256()
+    parts = [sys.executable, os.path.abspath(__file__)]
+    parts.extend('%s=%s' % (name, os.environ.get(name, '')) for name in KERNEL_ENVIRONMENT)
+    parts.extend(_kernel_spec_parts())
+    for part in parts:
+        h.update(part.encode('utf-8', 'surrogateescape') + b'\0')
+    return os.path.join(jupyter_runtime_dir(), 'ptvs-kernel-pool-%s.json' % h.hexdigest()[:16])
+
+def _read_state(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _send_json(sock, obj):
+    sock.sendall((json.dumps(obj) + '\n').encode('utf-8'))
+
+def _recv_json(sock):
+    buffer = b''
+    while b'\n' not in buffer:
+        data = sock.recv(4096)
+        if not data:
+            raise EOFError('kernel pool closed the connection')
+        buffer += data
+    return json.loads(buffer.partition(b'\n')[0].decode('utf-8'))
+
+class KernelClaim(object):
+    """a kernel claimed from the pool, which is shut down when the claim is
+    closed"""
+
+    def __init__(self, sock, token, kernel_id, connection_info):
+        self.sock = sock
+        self.token = token
+        self.kernel_id = kernel_id
+        self.connection_info = connection_info
+
+    def interrupt(self):
+        """asks the pool to interrupt the kernel"""
+        # the pool closes connections, and shuts down their kernel, on any
+        # request without the token
+        _send_json(self.sock, {'op': 'interrupt', 'token': self.token})
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+def claim_kernel(size):
+    """returns a KernelClaim for a ready kernel, or None if there is none.
+
+    Starts the pool in the background when it is not running, so that later
+    REPLs can use it."""
+    path = _state_file()
+    state = _read_state(path)
+    if state is not None:
+        sock = None
+        try:
+            sock = socket.create_connection(('127.0.0.1', state['port']), timeout=CLAIM_TIMEOUT)
+            _send_json(sock, {'op': 'claim', 'token': state['token']})
+            reply = _recv_json(sock)
+        except (socket.error, EOFError, KeyError, ValueError):
+            if sock is not None:
+                sock.close()
+        else:
+            if 'connection' in reply:
+                sock.settimeout(None)
+                return KernelClaim(sock, state['token'], reply['id'], reply['connection'])
+            # The pool is running but has no kernel ready yet
+            sock.close()
+            return None
+
+    start_pool(path, size)
+    return None
+
+def start_pool(path, size):
+    """starts a detached pool process that publishes itself in path"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = 'import sys; sys.path.insert(0, %r); from ptvsd.repl.jupyter_kernel_pool import main; main()' % root
+    args = [sys.executable, '-c', code, '--state-file', path, '--size', str(size)]
+
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    devnull = open(os.devnull, 'r+b')
+    try:
+        # Run from the runtime directory so files in the REPL's working
+        # directory cannot shadow modules the pool imports.
+        subprocess.Popen(
+            args,
+            cwd=os.path.dirname(path),
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            **kwargs
+        )
+    except OSError:
+        traceback.print_exc()
+    finally:
+        devnull.close()
+
+class PooledKernel(object):
+    def __init__(self, km):
+        self.km = km
+        self.kernel_id = str(uuid.uuid4())
+        self.created = time.time()
+
+    def connection_info(self):
+        info = dict(self.km.get_connection_info())
+        if isinstance(info.get('key'), bytes):
+            info['key'] = info['key'].decode('ascii')
+        return info
+
+    def is_alive(self):
+        try:
+            return self.km.is_alive()
+        except Exception:
+            return False
+
+    def interrupt(self):
+        try:
+            self.km.interrupt_kernel()
+        except Exception:
+            traceback.print_exc()
+
+    def shutdown(self):
+        try:
+            self.km.shutdown_kernel(now=True)
+        except Exception:
+            traceback.print_exc()
+
+class _Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.kernel = None
+
+class KernelPool(object):
+    """serves pre-initialized kernels to REPLs over a loopback socket"""
+
+    poll_interval = 1.0
+    max_request_size = 64 * 1024
+
+    def __init__(self, state_file, size, max_age=DEFAULT_MAX_AGE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.state_file = state_file
+        self.size = size
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.token = uuid.uuid4().hex
+        self.ready = deque()
+        self.starting = 0
+        self.closing = False
+        self.last_used = time.time()
+        self.connections = {}
+        self.shutdown_threads = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _start_kernel(self):
+        import jupyter_client.manager
+        from ptvsd.repl.jupyter_client import EXEC_HELPERS_COMMAND
+
+        km = jupyter_client.manager.KernelManager()
+        km.start_kernel()
+        kernel = PooledKernel(km)
+        kc = km.client()
+        try:
+            kc.start_channels()
+            kc.wait_for_ready(timeout=KERNEL_STARTUP_TIMEOUT)
+
+            msg_id = kc.execute(EXEC_HELPERS_COMMAND, silent=True, store_history=False)
+            deadline = time.time() + KERNEL_STARTUP_TIMEOUT
+            while True:
+                reply = kc.get_shell_msg(timeout=max(0, deadline - time.time()))
+                if reply['parent_header'].get('msg_id') == msg_id:
+                    break
+            if reply['content'].get('status') != 'ok':
+                raise RuntimeError('REPL helpers failed: %r' % (reply['content'],))
+        except:
+            kernel.shutdown()
+            raise
+        finally:
+            kc.stop_channels()
+        return kernel
+
+    def _fill_thread(self):
+        """keeps the ready list at the pool size, replacing kernels that have
+        exited or outlived max_age"""
+        while True:
+            with self._lock:
+                if self.closing:
+                    return
+                now = time.time()
+                stale = [k for k in self.ready if now - k.created > self.max_age or not k.is_alive()]
+                for k in stale:
+                    self.ready.remove(k)
+                start = len(self.ready) + self.starting < self.size
+                if start:
+                    self.starting += 1
+                elif not stale:
+                    self._changed.wait(self.poll_interval)
+
+            for k in stale:
+                k.shutdown()
+            if not start:
+                continue
+
+            kernel = None
+            try:
+                kernel = self._start_kernel()
+            except Exception:
+                traceback.print_exc()
+            with self._lock:
+                self.starting -= 1
+                if kernel is not None and not self.closing:
+                    self.ready.append(kernel)
+                    kernel = None
+            if kernel is not None:
+                kernel.shutdown()
+            elif not self.ready:
+                # Do not spin when kernels fail to start
+                time.sleep(self.poll_interval)
+
+    def _claim(self):
+        with self._lock:
+            self.last_used = time.time()
+            kernel = None
+            while self.ready and kernel is None:
+                kernel = self.ready.popleft()
+                if not kernel.is_alive():
+                    kernel = None
+            self._changed.notify()
+        return kernel
+
+    def _handle_request(self, conn, request):
+        if not hmac.compare_digest(str(request.get('token', '')), self.token):
+            return False
+
+        op = request.get('op')
+        if op == 'claim' and conn.kernel is None:
+            conn.kernel = self._claim()
+            if conn.kernel is None:
+                _send_json(conn.sock, {'error': 'no kernel is ready'})
+            else:
+                _send_json(conn.sock, {'id': conn.kernel.kernel_id, 'connection': conn.kernel.connection_info()})
+            return True
+        if op == 'interrupt' and conn.kernel is not None:
+            # the REPL does not wait for a reply
+            conn.kernel.interrupt()
+            return True
+
+        _send_json(conn.sock, {'error': 'unsupported request %r' % (op,)})
+        return True
+
+    def _read(self, conn):
+        """handles data from a connection, returning False once it closes"""
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error:
+            return False
+        if not data:
+            return False
+        conn.buffer += data
+        if len(conn.buffer) > self.max_request_size:
+            return False
+        while b'\n' in conn.buffer:
+            line, _, conn.buffer = conn.buffer.partition(b'\n')
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not self._handle_request(conn, request):
+                    return False
+            except (ValueError, AttributeError, socket.error):
+                return False
+        return True
+
+    def _close(self, conn):
+        del self.connections[conn.sock]
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        if conn.kernel is not None:
+            # shutting down waits for the kernel to exit, which would stall
+            # every other connection
+            self.shutdown_threads = [t for t in self.shutdown_threads if t.is_alive()]
+            t = threading.Thread(target=conn.kernel.shutdown, name='kernel-pool-shutdown', daemon=True)
+            t.start()
+            self.shutdown_threads.append(t)
+        self.last_used = time.time()
+
+    def _publish(self, port):
+        tmp = '%s.%d' % (self.state_file, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'port': port, 'token': self.token, 'pid': os.getpid()}, f)
+        os.replace(tmp, self.state_file)
+
+    def _unpublish(self):
+        state = _read_state(self.state_file)
+        if state is not None and state.get('token') == self.token:
+            try:
+                os.unlink(self.state_file)
+            except OSError:
+                pass
+
+    def serve(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(16)
+        self._publish(listener.getsockname()[1])
+
+        threading.Thread(target=self._fill_thread, name='kernel-pool-fill', daemon=True).start()
+        try:
+            while self.connections or time.time() - self.last_used < self.idle_timeout:
+                socks = [listener]
+                socks.extend(self.connections)
+                readable = select.select(socks, [], [], self.poll_interval)[0]
+                for sock in readable:
+                    if sock is listener:
+                        client, _ = listener.accept()
+                        client.settimeout(CLAIM_TIMEOUT)
+                        self.connections[client] = _Connection(client)
+                    elif not self._read(self.connections[sock]):
+                        self._close(self.connections[sock])
+        finally:
+            self._unpublish()
+            listener.close()
+            with self._lock:
+                self.closing = True
+                ready = list(self.ready)
+                self.ready.clear()
+                self._changed.notify()
+            for conn in list(self.connections.values()):
+                self._close(conn)
+            for kernel in ready:
+                kernel.shutdown()
+            for t in self.shutdown_threads:
+                t.join()
+
+def _is_pool_running(state_file):
+    state = _read_state(state_file)
+    if state is None:
+        return False
+    try:
+        socket.create_connection(('127.0.0.1', state['port']), timeout=CLAIM_TIMEOUT).close()
+    except (socket.error, KeyError):
+        return False
+    return True
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Keeps Jupyter kernels ready for the PTVS REPL')
+    parser.add_argument('--state-file', required=True)
+    parser.add_argument('--size', type=int, default=1)
+    parser.add_argument('--max-age', type=float, default=DEFAULT_MAX_AGE)
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT)
+    args = parser.parse_args()
+
+    if _is_pool_running(args.state_file):
+        # Another REPL already started a pool for this environment
+        return
+
+    KernelPool(args.state_file, max(1, args.size), args.max_age, args.idle_timeout).serve()
+
+if __name__ == '__main__':
+    main()
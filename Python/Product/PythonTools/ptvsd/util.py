@@ -137,14 +137,29 @@ ASCII_PREFIX = to_bytes('A')
 NONE_PREFIX = to_bytes('N')
 
 
+def _recv_into(conn, view, count):
+    try:
+        recv_into = conn.recv_into
+    except AttributeError:
+        data = conn.recv(count)
+        if not data:
+            return 0
+        view[:len(data)] = data
+        return len(data)
+    return recv_into(view, count)
+
+
 def read_bytes(conn, count):
-    b = to_bytes('')
-    while len(b) < count:
-        received_data = conn.recv(count - len(b))
-        if received_data is None:
-            break
-        b += received_data
-    return b
+    b = bytearray(count)
+    view = memoryview(b)
+    received = 0
+    while received < count:
+        n = _recv_into(conn, view[received:], count - received)
+        if not n:
+            # connection was closed before the full message arrived
+            return view[:received].tobytes()
+        received += n
+    return view.tobytes()
 
 
 def write_bytes(conn, b):
@@ -159,16 +174,8 @@ def write_int(conn, i):
     write_bytes(conn, struct.pack('!q', i))
 
 
-def read_string(conn):
-    """ reads length of text to read, and then the text encoded in UTF-8, and returns the string"""
-    strlen = read_int(conn)
-    if not strlen:
-        return ''
-    res = to_bytes('')
-    while len(res) < strlen:
-        res = res + conn.recv(strlen - len(res))
-
-    res = utf_8.decode(res)[0]
+def _decode_string(b):
+    res = utf_8.decode(b)[0]
     if sys.version_info[0] == 2 and sys.platform != 'cli':
         # Py 2.x, we want an ASCII string if possible
         try:
@@ -179,22 +186,106 @@ def read_string(conn):
     return res
 
 
+def read_string(conn):
+    """ reads length of text to read, and then the text encoded in UTF-8, and returns the string"""
+    strlen = read_int(conn)
+    if not strlen:
+        return ''
+    return _decode_string(read_bytes(conn, strlen))
+
+
+class SocketReader(object):
+    """Reads the wire format used by `read_bytes`, `read_int` and
+    `read_string` from a connection through a single reusable receive buffer.
+
+    Data is received with `recv_into` and kept in the buffer until it has been
+    consumed, so a timeout part way through a message does not lose the bytes
+    that have already arrived."""
+    buffer_size = 64 * 1024
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._buf = bytearray(self.buffer_size)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self, count):
+        """ensures at least count bytes are buffered, returning False if the
+        connection was closed first"""
+        pending = self._end - self._start
+        if pending >= count:
+            return True
+
+        buf = self._buf
+        if self._start + count > len(buf):
+            # move the pending data to the front, growing the buffer if the
+            # message cannot fit in it
+            if count > len(buf):
+                buf = bytearray(max(count, 2 * len(buf)))
+            buf[:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+            self._start = 0
+            self._end = pending
+
+        view = memoryview(buf)
+        while self._end - self._start < count:
+            n = _recv_into(self.conn, view[self._end:], len(buf) - self._end)
+            if not n:
+                return False
+            self._end += n
+        return True
+
+    def read_bytes(self, count):
+        self._fill(count)
+        start = self._start
+        end = min(start + count, self._end)
+        res = memoryview(self._buf)[start:end].tobytes()
+        if end == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self.buffer_size:
+                # release the memory held for a large message
+                self._buf = bytearray(self.buffer_size)
+        else:
+            self._start = end
+        return res
+
+    def read_int(self):
+        return struct.unpack('!q', self.read_bytes(8))[0]
+
+    def read_string(self):
+        strlen = self.read_int()
+        if not strlen:
+            return ''
+        return _decode_string(self.read_bytes(strlen))
+
+
 def write_string(conn, s):
     if s is None:
         write_bytes(conn, NONE_PREFIX)
     elif isinstance(s, unicode):
         b = utf_8.encode(s)[0]
-        b_len = len(b)
-        write_bytes(conn, UNICODE_PREFIX)
-        write_int(conn, b_len)
-        if b_len > 0:
-            write_bytes(conn, b)
+        write_bytes(conn, UNICODE_PREFIX + struct.pack('!q', len(b)) + b)
     else:
-        s_len = len(s)
-        write_bytes(conn, ASCII_PREFIX)
-        write_int(conn, s_len)
-        if s_len > 0:
-            write_bytes(conn, s)
+        write_bytes(conn, ASCII_PREFIX + struct.pack('!q', len(s)) + s)
+
+
+class MessageBuilder(object):
+    """Accumulates the output of `write_bytes`, `write_int` and `write_string`
+    so that a complete command can be sent with a single `sendall` call.
+
+    The builder is passed in place of the connection to the write functions,
+    which means the wire format is identical to writing directly to the
+    socket."""
+    def __init__(self, cmd=None):
+        self.buffer = bytearray()
+        if cmd is not None:
+            self.buffer += cmd
+
+    def sendall(self, b):
+        self.buffer += b
+
+    def send(self, conn):
+        conn.sendall(self.buffer)
 
 class SafeRepr(object):
     # String types are truncated to maxstring_outer when at the outer-
@@ -20,12 +20,23 @@ __version__ = "3.0.0"
 
 import ctypes
 import datetime
+import errno
+import gc
+import hashlib
+import io
+import json
 import os
 import re
+import signal
+import socket
+import stat
 import struct
 import sys
+import tempfile
+import threading
+import time
 import traceback
-from xml.dom import minidom
+from collections import deque
 
 try:
     from cStringIO import StringIO
@@ -36,6 +47,14 @@ try:
     from thread import start_new_thread
 except ImportError:
     from _thread import start_new_thread
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 if sys.version_info[0] == 3:
     def to_str(value):
@@ -89,6 +108,11 @@ class FastCgiRecord(object):
         self.role = role
         self.flags = flags
         self.params = {}
+        # The start of a name/value pair that continues in the next
+        # FCGI_PARAMS record
+        self.params_pending = None
+        # When the request began and when its params were complete
+        self.started = self.params_received = None
         
     def __repr__(self):
         return '<FastCgiRecord(%d, %d, %d, %d)>' % (self.type, 
@@ -96,6 +120,16 @@ class FastCgiRecord(object):
                                                     self.role, 
                                                     self.flags)
 
+#typedef struct {
+#   unsigned char appStatusB3;
+#   unsigned char appStatusB2;
+#   unsigned char appStatusB1;
+#   unsigned char appStatusB0;
+#   unsigned char protocolStatus;
+#   unsigned char reserved[3];
+#} FCGI_EndRequestBody;
+FCGI_END_REQUEST_BODY = struct.Struct('>IB3x')
+
 #typedef struct {
 #   unsigned char version;
 #   unsigned char type;
@@ -121,7 +155,8 @@ if sys.version_info[0] >= 3:
         return bytes((x, ))
 
     def wsgi_decode(x):
-        return x.decode('iso-8859-1')
+        # also accepts memoryviews of record content
+        return str(x, 'iso-8859-1')
     def wsgi_encode(x):
         return x.encode('iso-8859-1')
 
@@ -153,17 +188,81 @@ else:
     def zero_bytes(length):
         return '\x00' * length
 
-def read_fastcgi_record(stream):
-    """reads the main fast cgi record"""
-    data = stream.read(8)     # read record
-    if not data:
-        # no more data, our other process must have died...
-        raise _ExitException()
+# Used to time requests when WSGI_METRICS_PATH is set
+_clock = getattr(time, 'perf_counter', time.time)
+
+FCGI_RECORD_HEADER = struct.Struct('>BBHHBB')
+FCGI_MAX_CONTENT_LEN = 0xFFFF
+_ENCODED_INT = struct.Struct('>I')
 
-    fcgi_ver, reqtype, req_id, content_size, padding_len, _ = struct.unpack('>BBHHBB', data)
+class FastCgiStream(object):
+    """The connection to the web server. Records are read in large blocks
+    into a reusable buffer and returned without copying their content."""
 
-    content = stream.read(content_size)  # read content
-    stream.read(padding_len)
+    buffer_size = 256 * 1024
+    # Python 2 cannot write memoryviews to files or StringIO
+    copy_content = sys.version_info[0] < 3
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._raw = io.FileIO(stream.fileno(), 'rb', closefd=False)
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # Requests on this connection that have not yet ended, by ID
+        self.requests = {}
+        # Serializes records written by requests multiplexed on this
+        # connection. Other connections write independently, so a client
+        # that reads slowly only holds up its own requests.
+        self.send_lock = threading.Lock()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def _fill(self, count):
+        """Ensures that count bytes are buffered, returning False if the
+        connection closes first."""
+        if self._end - self._start >= count:
+            return True
+        if self._start + count > len(self._buffer):
+            # Move the partial record to the start of the buffer. The buffer
+            # is never resized, as earlier content may still be referenced.
+            remaining = self._end - self._start
+            self._buffer[:remaining] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, remaining
+        while self._end - self._start < count:
+            read = self._raw.readinto(self._view[self._end:])
+            if not read:
+                return False
+            self._end += read
+        return True
+
+    def read_record(self):
+        """Returns the version, type, request ID and content of the next
+        record. The content is only valid until the next record is read."""
+        if not self._fill(FCGI_HEADER_LEN):
+            # no more data, our other process must have died...
+            raise _ExitException()
+
+        fcgi_ver, reqtype, req_id, content_size, padding_len, _ = FCGI_RECORD_HEADER.unpack_from(
+            self._buffer, self._start
+        )
+        if not self._fill(FCGI_HEADER_LEN + content_size + padding_len):
+            raise _ExitException()
+
+        start = self._start + FCGI_HEADER_LEN
+        content = self._view[start:start + content_size]
+        if self.copy_content:
+            content = content.tobytes()
+        self._start = start + content_size + padding_len
+        if self._start == self._end:
+            self._start = self._end = 0
+        return fcgi_ver, reqtype, req_id, content
+
+def read_fastcgi_record(stream):
+    """reads the main fast cgi record"""
+    fcgi_ver, reqtype, req_id, content = stream.read_record()
 
     if fcgi_ver != FCGI_VERSION_1:
         raise Exception('Unknown fastcgi version %s' % fcgi_ver)
@@ -174,13 +273,13 @@ def read_fastcgi_record(stream):
 
     # unknown type requested, send response
     log('Unknown request type %s' % reqtype)
-    send_response(stream, req_id, FCGI_UNKNOWN_TYPE, chr(reqtype) + zero_bytes(7))
+    send_response(stream, req_id, FCGI_UNKNOWN_TYPE, chr(reqtype) + zero_bytes(7), streaming=False)
     return None
 
 
 def read_fastcgi_begin_request(stream, req_id, content):
-    """reads the begin request body and updates our _REQUESTS table to include
-    the new request"""
+    """reads the begin request body and updates the connection's requests
+    table to include the new request"""
     #    typedef struct {
     #        unsigned char roleB1;
     #        unsigned char roleB0;
@@ -189,21 +288,43 @@ def read_fastcgi_begin_request(stream, req_id, content):
     #    } FCGI_BeginRequestBody;
 
     # TODO: Ignore request if it exists
-    res = FastCgiRecord(
-        FCGI_BEGIN_REQUEST,
-        req_id,
-        (ord(content[0]) << 8) | ord(content[1]),   # role
-        ord(content[2]),  # flags
-    )
-    _REQUESTS[req_id] = res
+    global _REQUEST_COUNT
+    with _REQUESTS_CHANGED:
+        if _DRAINING and _REFUSE_REQUESTS:
+            # We are restarting, so let the host send the request elsewhere
+            send_response(
+                stream,
+                req_id,
+                FCGI_END_REQUEST,
+                FCGI_END_REQUEST_BODY.pack(0, FCGI_OVERLOADED),
+                streaming=False,
+            )
+            return
+
+        stream.requests[req_id] = FastCgiRecord(
+            FCGI_BEGIN_REQUEST,
+            req_id,
+            (ord(content[0]) << 8) | ord(content[1]),   # role
+            ord(content[2]),  # flags
+        )
+        stream.requests[req_id].params['wsgi.input'] = FastCgiInput(
+            stream,
+            req_id,
+            get_input_spool_size(),
+            multiplexed=_WORKERS is not None,
+            streaming=is_input_streamed(),
+        )
+        _REQUEST_COUNT += 1
+        if _METRICS is not None:
+            stream.requests[req_id].started = _clock()
 
 def read_encoded_int(content, offset):
-    i = struct.unpack_from('>B', content, offset)[0]
+    i = ord(content[offset])
 
     if i < 0x80:
         return offset + 1, i
     
-    return offset + 4, struct.unpack_from('>I', content, offset)[0] & ~0x80000000
+    return offset + 4, _ENCODED_INT.unpack_from(content, offset)[0] & ~0x80000000
 
 
 def read_fastcgi_keyvalue_pairs(content, offset):
@@ -212,14 +333,37 @@ def read_fastcgi_keyvalue_pairs(content, offset):
     offset, name_len = read_encoded_int(content, offset)
     offset, value_len = read_encoded_int(content, offset)
 
-    name = content[offset:(offset + name_len)]
+    name = bytes(content[offset:(offset + name_len)])
     offset += name_len
     
-    value = content[offset:(offset + value_len)]
+    value = bytes(content[offset:(offset + value_len)])
     offset += value_len
 
     return offset, name, value
 
+def split_fastcgi_keyvalue_pair(content, offset):
+    """Returns the offset after the name/value pair at offset and slices of
+    content for its name and value, or None if the pair is incomplete."""
+    end = len(content)
+    lengths = []
+    for _ in range(2):
+        if offset >= end:
+            return None
+        if ord(content[offset]) < 0x80:
+            lengths.append(ord(content[offset]))
+            offset += 1
+        elif offset + 4 <= end:
+            lengths.append(_ENCODED_INT.unpack_from(content, offset)[0] & ~0x80000000)
+            offset += 4
+        else:
+            return None
+
+    name_end = offset + lengths[0]
+    value_end = name_end + lengths[1]
+    if value_end > end:
+        return None
+    return value_end, content[offset:name_end], content[name_end:value_end]
+
 
 def get_encoded_int(i):
     """Writes the length of a single name for a key or value in a key/value
@@ -257,39 +401,212 @@ RAW_VALUE_NAMES = {
 }
 
 def read_fastcgi_params(stream, req_id, content):
+    record = stream.requests.get(req_id)
+    if record is None:
+        # the request was refused while draining
+        return None
     if not content:
+        if record.started is not None:
+            record.params_received = _clock()
+        if record.params['wsgi.input'].streaming:
+            # All params have arrived, so the request can start while the
+            # body is still being received.
+            return record
         return None
 
+    if record.params_pending:
+        content = record.params_pending + bytes(content)
+        record.params_pending = None
+
     offset = 0
-    res = _REQUESTS[req_id].params
+    res = record.params
     while offset < len(content):
-        offset, name, value = read_fastcgi_keyvalue_pairs(content, offset)
+        pair = split_fastcgi_keyvalue_pair(content, offset)
+        if pair is None:
+            # The pair continues in the next record
+            record.params_pending = bytes(content[offset:])
+            break
+        offset, name, value = pair
         name = wsgi_decode(name)
         raw_name = RAW_VALUE_NAMES.get(name)
         if raw_name:
-            res[raw_name] = value
+            res[raw_name] = bytes(value)
         res[name] = wsgi_decode(value)
 
 
 def read_fastcgi_input(stream, req_id, content):
-    """reads FastCGI std-in and stores it in wsgi.input passed in the
+    """reads FastCGI std-in and appends it to wsgi.input passed in the
     wsgi environment array"""
-    res = _REQUESTS[req_id].params
-    if 'wsgi.input' not in res:
-        res['wsgi.input'] = BytesIO()
-    res['wsgi.input'].write(content)
-
-    if not content:
+    record = stream.requests.get(req_id)
+    if record is None:
+        # the request has already completed without reading all of its
+        # input, so the rest is discarded
+        return None
+    body = record.params['wsgi.input']
+    body.append(content)
+    if not content and not body.streaming:
         # we've hit the end of the input stream, time to process input...
-        return _REQUESTS[req_id]
+        return record
+
+
+class FastCgiInput(object):
+    """The wsgi.input stream for a request.
+
+    Received data is kept so that the application can seek back over it, and
+    is moved from memory to a temporary file once it exceeds spool_size
+    bytes.
+
+    When streaming, the application is started before the request body has
+    arrived, and reading blocks until enough FCGI_STDIN records have been
+    received. When requests are multiplexed, the main thread receives the
+    records and the request's worker thread waits for them. Otherwise,
+    reading the input reads records from the FastCGI stream."""
+
+    def __init__(self, stream, req_id, spool_size, multiplexed=False, streaming=False):
+        self.streaming = streaming
+        self._stream = stream
+        self._req_id = req_id
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._received = 0
+        self._pos = 0
+        self._multiplexed = multiplexed
+        # Reentrant, because reading records for this request appends to it
+        self._ready = threading.Condition(threading.RLock())
+        self._closed = False
+        self.complete = False
+        # Seconds spent waiting for input to arrive
+        self.wait_time = 0.0
+
+    def append(self, content):
+        """adds data from an FCGI_STDIN record. An empty record marks the end
+        of the input."""
+        with self._ready:
+            if self._closed:
+                # the request completed without reading all of its input
+                return
+            if not content:
+                self.complete = True
+            else:
+                self._spool.seek(0, 2)
+                self._spool.write(content)
+                self._received += len(content)
+            self._ready.notify_all()
+
+    def _fill(self):
+        """waits for more input, returning False if no more will arrive"""
+        received = self._received
+        start = _clock()
+        while not self.complete and self._received == received:
+            if self._multiplexed:
+                self._ready.wait()
+            else:
+                # Requests are not multiplexed, so only records belonging
+                # to this request can arrive before it completes.
+                read_fastcgi_record(self._stream)
+        self.wait_time += _clock() - start
+        return self._received != received
+
+    def _read_available(self, size):
+        self._spool.seek(self._pos)
+        data = self._spool.read(size)
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        with self._ready:
+            if size is None or size < 0:
+                while self._fill():
+                    pass
+                size = self._received - self._pos
+            else:
+                while self._received - self._pos < size and self._fill():
+                    pass
+            return self._read_available(size)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        parts = []
+        with self._ready:
+            while size != 0:
+                if self._pos == self._received and not self._fill():
+                    break
+                self._spool.seek(self._pos)
+                line = self._spool.readline(size)
+                self._pos += len(line)
+                parts.append(line)
+                if line.endswith(b'\n'):
+                    break
+                if size > 0:
+                    size -= len(line)
+        return bytes().join(parts)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if hint is not None and 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        with self._ready:
+            if whence == 1:
+                offset += self._pos
+            elif whence == 2:
+                while self._fill():
+                    pass
+                offset += self._received
+            while self._received < offset and self._fill():
+                pass
+            self._pos = max(0, min(offset, self._received))
+            return self._pos
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._spool.close()
+
+def get_input_spool_size():
+    """returns the number of request body bytes kept in memory before they
+    are moved to a temporary file"""
+    try:
+        return int(os.getenv('WSGI_INPUT_SPOOL_SIZE', ''))
+    except ValueError:
+        return DEFAULT_INPUT_SPOOL_SIZE
+
+DEFAULT_INPUT_SPOOL_SIZE = 1024 * 1024
+
+def is_input_streamed():
+    """returns True if requests start before their body has arrived"""
+    return os.getenv('WSGI_STREAM_INPUT', '').strip().lower() in ('1', 'true')
 
 
 def read_fastcgi_data(stream, req_id, content):
     """reads FastCGI data stream and publishes it as wsgi.data"""
-    res = _REQUESTS[req_id].params
+    record = stream.requests.get(req_id)
+    if record is None:
+        return
+    res = record.params
     if 'wsgi.data' not in res:
         res['wsgi.data'] = BytesIO()
-    res['wsgi.data'].write(content)
+    res['wsgi.data'].write(bytes(content))
 
 def read_fastcgi_abort_request(stream, req_id, content):
     """reads the wsgi abort request, which we ignore, we'll send the
@@ -304,23 +621,27 @@ def read_fastcgi_get_values(stream, req_id, content):
     request = {}
     while offset < len(content):
         offset, name, value = read_fastcgi_keyvalue_pairs(content, offset)
-        request[name] = value
+        request[wsgi_decode(name)] = value
 
     response = {}
     if FCGI_MAX_CONNS in request:
-        response[FCGI_MAX_CONNS] = '1'
+        response[FCGI_MAX_CONNS] = str(_MAX_CONNS)
 
     if FCGI_MAX_REQS in request:
-        response[FCGI_MAX_REQS] = '1'
+        response[FCGI_MAX_REQS] = str(_WORKERS.count) if _WORKERS else str(_MAX_CONNS)
 
     if FCGI_MPXS_CONNS in request:
-        response[FCGI_MPXS_CONNS] = '0'
+        response[FCGI_MPXS_CONNS] = '1' if _WORKERS else '0'
+
+    if WFASTCGI_METRICS in request and _METRICS is not None:
+        response[WFASTCGI_METRICS] = _METRICS.to_json()
 
     send_response(
         stream,
         req_id,
         FCGI_GET_VALUES_RESULT,
-        write_fastcgi_keyvalue_pairs(response)
+        write_fastcgi_keyvalue_pairs(response),
+        streaming=False,
     )
 
 
@@ -337,19 +658,153 @@ REQUEST_PROCESSORS = {
 
 APPINSIGHT_CLIENT = None
 
-def log(txt):
-    """Logs messages to a log file if WSGI_LOG env var is defined."""
-    if APPINSIGHT_CLIENT:
+class _LogWriter(object):
+    """Writes log messages to the WSGI_LOG file and Application Insights on a
+    background thread. The file is kept open and written in batches, and
+    messages are dropped rather than blocking the caller when too many are
+    waiting."""
+
+    max_queued = 10000
+    flush_interval = 1.0
+
+    def __init__(self):
+        self._queue = Queue(self.max_queued)
+        self._lock = threading.Lock()
+        self._started = False
+        self._path = None
+        self._file = None
+        self._last_flush = 0
+        # Approximate, as it is updated without a lock
+        self.dropped = 0
+
+    def write(self, txt):
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    start_new_thread(self._run, ())
+                    self._started = True
         try:
-            APPINSIGHT_CLIENT.track_event(txt)
-        except:  # nosec B110
-            pass  # nosec B110 - telemetry failures must not break request logging.
-    
-    log_file = os.environ.get('WSGI_LOG')
-    if log_file:
-        with open(log_file, 'a+', encoding='utf-8') as f:
+            self._queue.put_nowait((datetime.datetime.now(), txt))
+        except Full:
+            self.dropped += 1
+
+    def flush(self, timeout):
+        """Waits up to timeout seconds for queued messages to be written."""
+        if not self._started:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put((None, done), timeout=timeout)
+        except Full:
+            return
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_queued:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                # There is nowhere to report this, but the next batch may
+                # succeed
+                self._close()
+
+    def _write(self, batch):
+        path = os.environ.get('WSGI_LOG')
+        if path != self._path:
+            self._close()
+            self._path = path
+        if path and self._file is None:
+            self._file = open(path, 'a+', encoding='utf-8')
+
+        client = APPINSIGHT_CLIENT
+        lines = []
+        waiting = []
+        for when, txt in batch:
+            if when is None:
+                waiting.append(txt)
+                continue
+            if client:
+                try:
+                    client.track_event(txt)
+                except:  # nosec B110
+                    pass  # nosec B110 - telemetry failures must not break request logging.
             txt = txt.replace('\r\n', '\n')
-            f.write('%s: %s%s' % (datetime.datetime.now(), txt, '' if txt.endswith('\n') else '\n'))
+            lines.append('%s: %s%s' % (when, txt, '' if txt.endswith('\n') else '\n'))
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append('%s: %s log messages were dropped\n' % (datetime.datetime.now(), dropped))
+
+        if self._file is not None:
+            if lines:
+                self._file.write(''.join(lines))
+            now = time.time()
+            if waiting or self._queue.empty() or now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+                self._rotate()
+
+        for done in waiting:
+            done.set()
+
+    def _rotate(self):
+        """Moves the log file to WSGI_LOG.1 once it reaches
+        WSGI_LOG_MAX_SIZE bytes."""
+        max_size = get_log_max_size()
+        if not max_size or os.fstat(self._file.fileno()).st_size < max_size:
+            return
+        self._close()
+        try:
+            # Another process may have already moved it
+            if os.path.getsize(self._path) >= max_size:
+                backup = self._path + '.1'
+                if os.path.exists(backup):
+                    os.remove(backup)
+                os.rename(self._path, backup)
+        except OSError:
+            # The file is still open in another process, so keep writing to
+            # it and try again later
+            pass
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+def get_log_max_size():
+    """returns the size in bytes at which the log file is moved aside, or 0
+    to let it grow without limit"""
+    try:
+        return max(int(os.getenv('WSGI_LOG_MAX_SIZE', '')), 0)
+    except ValueError:
+        return 0
+
+_LOG_WRITER = _LogWriter()
+
+def log(txt):
+    """Logs messages to a log file if WSGI_LOG env var is defined. Messages
+    are written on a background thread, so this does not wait for the file."""
+    if APPINSIGHT_CLIENT or os.environ.get('WSGI_LOG'):
+        _LOG_WRITER.write(txt)
+
+def flush_log(timeout=5.0):
+    """Waits for logged messages to be written."""
+    _LOG_WRITER.flush(timeout)
+
+def reset_log():
+    """Replaces the log writer in a forked process, where its thread no
+    longer exists. The log should be flushed before forking."""
+    global _LOG_WRITER
+    _LOG_WRITER = _LogWriter()
 
 def maybe_log(txt):
     """Logs messages to a log file if WSGI_LOG env var is defined, and does not
@@ -359,118 +814,269 @@ def maybe_log(txt):
     except:  # nosec B110
         pass  # nosec B110 - maybe_log intentionally suppresses logging failures.
 
+class RecordWriter(object):
+    """Collects the records for one request and writes them together.
+
+    Record headers are packed into a reusable buffer, and content is sent
+    from memoryviews of the original data without copying it into records.
+    Records are written when flush() is called, or once more than flush_size
+    bytes or max_parts buffers are pending."""
+
+    flush_size = 256 * 1024
+    # Stays below IOV_MAX, which is 1024 on most platforms
+    max_parts = 512
+
+    def __init__(self, stream, req_id):
+        self.stream = stream
+        self.req_id = req_id
+        self._headers = bytearray(FCGI_HEADER_LEN * (self.max_parts // 2))
+        self._header_views = memoryview(self._headers)
+        self._header_count = 0
+        self._parts = []
+        self._size = 0
+
+    def add(self, resp_type, content):
+        """Queues content as records of resp_type. Empty content is queued as
+        a single empty record, which terminates a stream."""
+        view = memoryview(content)
+        offset = 0
+        while True:
+            length = min(len(view) - offset, FCGI_MAX_CONTENT_LEN)
+            if (self._header_count * FCGI_HEADER_LEN >= len(self._headers) or
+                len(self._parts) + 2 > self.max_parts):
+                self.flush()
+
+            start = self._header_count * FCGI_HEADER_LEN
+            FCGI_RECORD_HEADER.pack_into(
+                self._headers,
+                start,
+                FCGI_VERSION_1,     # version
+                resp_type,          # type
+                self.req_id,        # requestIdB1:B0
+                length,             # contentLengthB1:B0
+                0,                  # paddingLength
+                0,                  # reserved
+            )
+            self._header_count += 1
+            self._parts.append(self._header_views[start:start + FCGI_HEADER_LEN])
+            if length:
+                self._parts.append(view[offset:offset + length])
+            self._size += FCGI_HEADER_LEN + length
+            offset += length
+
+            if self._size >= self.flush_size:
+                self.flush()
+            if offset >= len(view):
+                break
+
+    def flush(self):
+        """Writes all queued records."""
+        if not self._parts:
+            return
+        parts = self._parts
+        with self.stream.send_lock:
+            write_all(self.stream.fileno(), parts)
+        self._parts = []
+        self._size = 0
+        self._header_count = 0
+
+if hasattr(os, 'writev'):
+    def write_all(fd, parts):
+        """Writes all the buffers in parts, retrying after short writes."""
+        while parts:
+            written = os.writev(fd, parts)
+            while parts and written >= len(parts[0]):
+                written -= len(parts[0])
+                del parts[0]
+            if written:
+                parts[0] = parts[0][written:]
+else:
+    def write_all(fd, parts):
+        """Writes all the buffers in parts, retrying after short writes."""
+        data = bytearray()
+        for part in parts:
+            data += part
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
 def send_response(stream, req_id, resp_type, content, streaming=True):
     """sends a response w/ the given id, type, and content to the server.
     If the content is streaming then an empty record is sent at the end to 
     terminate the stream"""
     if not isinstance(content, bytes):
         raise TypeError("content must be encoded before sending: %r" % content)
-    
-    offset = 0
-    while True:
-        len_remaining = max(min(len(content) - offset, 0xFFFF), 0)
-
-        data = struct.pack(
-            '>BBHHBB',
-            FCGI_VERSION_1,     # version
-            resp_type,          # type
-            req_id,             # requestIdB1:B0
-            len_remaining,      # contentLengthB1:B0
-            0,                  # paddingLength
-            0,                  # reserved
-        ) + content[offset:(offset + len_remaining)]
-
-        offset += len_remaining
-
-        os.write(stream.fileno(), data)
-        if len_remaining == 0 or not streaming:
-            break
-    stream.flush()
 
-def get_environment(dir):
-    web_config = os.path.join(dir, 'Web.config')
-    if not os.path.exists(web_config):
-        return {}
+    writer = RecordWriter(stream, req_id)
+    writer.add(resp_type, content)
+    if streaming and content:
+        writer.add(resp_type, zero_bytes(0))
+    writer.flush()
 
+def read_app_settings(web_config):
+    """returns the keys and values of the add elements in the appSettings
+    section of web_config. Parsing stops at the end of the section, so the
+    rest of the file (such as rewrite rules) is never read."""
     d = {}
-    doc = minidom.parse(web_config)
-    config = doc.getElementsByTagName('configuration')
-    for configSection in config:
-        appSettings = configSection.getElementsByTagName('appSettings')
-        for appSettingsSection in appSettings:
-            values = appSettingsSection.getElementsByTagName('add')
-            for curAdd in values:
-                key = curAdd.getAttribute('key')
-                value = curAdd.getAttribute('value')
-                if key and value is not None:
-                    d[key.strip()] = value
+    tags = []
+    with open(web_config, 'rb') as f:
+        for event, elem in iterparse(f, ('start', 'end')):
+            # ignore any namespace that the elements are in
+            tag = elem.tag.rpartition('}')[2]
+            if event == 'start':
+                tags.append(tag)
+                continue
+            tags.pop()
+            if 'configuration' in tags:
+                if tag == 'appSettings':
+                    break
+                if tag == 'add' and 'appSettings' in tags:
+                    key = elem.get('key')
+                    if key:
+                        d[key.strip()] = elem.get('value', '')
+            elem.clear()
     return d
 
-ReadDirectoryChangesW = ctypes.windll.kernel32.ReadDirectoryChangesW
-ReadDirectoryChangesW.restype = ctypes.c_uint32
-ReadDirectoryChangesW.argtypes  = [
-    ctypes.c_void_p,     # HANDLE hDirectory
-    ctypes.c_void_p,     # LPVOID lpBuffer
-    ctypes.c_uint32,     # DWORD nBufferLength
-    ctypes.c_uint32,     # BOOL bWatchSubtree
-    ctypes.c_uint32,     # DWORD dwNotifyFilter
-    ctypes.POINTER(ctypes.c_uint32),  # LPDWORD lpBytesReturned
-    ctypes.c_void_p,     # LPOVERLAPPED lpOverlapped
-    ctypes.c_void_p      # LPOVERLAPPED_COMPLETION_ROUTINE lpCompletionRoutine
-]
-try:
-    from _winapi import (CreateFile, CloseHandle, GetLastError, ExitProcess,
-                         WaitForSingleObject, INFINITE, OPEN_EXISTING)
-except ImportError:
-    CreateFile = ctypes.windll.kernel32.CreateFileW
-    CreateFile.restype = ctypes.c_void_p
-    CreateFile.argtypes  = [
-        ctypes.c_wchar_p,     # lpFilename
-        ctypes.c_uint32,      # dwDesiredAccess
-        ctypes.c_uint32,      # dwShareMode
-        ctypes.c_void_p,      # LPSECURITY_ATTRIBUTES,
-        ctypes.c_uint32,      # dwCreationDisposition,
-        ctypes.c_uint32,      # dwFlagsAndAttributes,
-        ctypes.c_void_p       # hTemplateFile
-    ]
-
-    CloseHandle = ctypes.windll.kernel32.CloseHandle
-    CloseHandle.argtypes = [ctypes.c_void_p]
-
-    GetLastError = ctypes.windll.kernel32.GetLastError
-    GetLastError.restype = ctypes.c_uint32
-
-    ExitProcess = ctypes.windll.kernel32.ExitProcess
-    ExitProcess.restype = ctypes.c_void_p
-    ExitProcess.argtypes  = [ctypes.c_uint32]
+def get_config_cache_path(web_config):
+    """returns the file that the settings read from web_config are cached in,
+    or None if there is nowhere that other users cannot write to"""
+    if hasattr(os, 'getuid'):
+        # The temp directory is shared, but files in it can only be replaced
+        # by their owner, and files owned by other users are never read
+        cache_dir = tempfile.gettempdir()
+    else:
+        # On Windows the temp directory may be shared and its files writable
+        # by other users, but local application data is in the user profile
+        local_app_data = os.getenv('LOCALAPPDATA')
+        if not local_app_data:
+            return None
+        cache_dir = os.path.join(local_app_data, 'wfastcgi')
+    path = os.path.abspath(web_config)
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    name = 'wfastcgi-%s.json' % hashlib.sha1(path).hexdigest()[:16]
+    return os.path.join(cache_dir, name)
 
-    WaitForSingleObject = ctypes.windll.kernel32.WaitForSingleObject
-    WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
-    WaitForSingleObject.restype = ctypes.c_uint32
+def get_environment(dir):
+    """returns the appSettings from Web.config in dir. The settings are cached
+    along with the size and modification time of the file, so processes
+    started again for an unchanged file do not parse it."""
+    web_config = os.path.join(dir, 'Web.config')
+    try:
+        st = os.stat(web_config)
+    except OSError:
+        return {}
 
-    OPEN_EXISTING = 3
-    INFINITE = -1
+    key = [os.path.abspath(web_config), st.st_mtime, st.st_size]
+    cache_path = get_config_cache_path(web_config)
+    if cache_path is None:
+        return read_app_settings(web_config)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            if hasattr(os, 'getuid') and os.fstat(f.fileno()).st_uid != os.getuid():
+                raise ValueError('%s is owned by another user' % cache_path)
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['settings']
+    except Exception:
+        # missing, unreadable or out of date
+        pass
 
-FILE_LIST_DIRECTORY = 1
-FILE_SHARE_READ = 0x00000001
-FILE_SHARE_WRITE = 0x00000002
-FILE_SHARE_DELETE = 0x00000004
-FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
-MAX_PATH = 260
-FILE_NOTIFY_CHANGE_LAST_WRITE  = 0x10
-ERROR_NOTIFY_ENUM_DIR = 1022
-INVALID_HANDLE_VALUE = 0xFFFFFFFF
+    d = read_app_settings(web_config)
+    try:
+        # appSettings may include secrets, so the cache is only readable by
+        # the current user
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'settings': d}, f)
+            try:
+                os.rename(temp_path, cache_path)
+            except OSError:
+                # Windows does not replace existing files when renaming
+                os.remove(cache_path)
+                os.rename(temp_path, cache_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+    except Exception:
+        maybe_log('Unable to cache settings from %s: %s' % (web_config, traceback.format_exc()))
+    return d
 
-class FILE_NOTIFY_INFORMATION(ctypes.Structure):
-    _fields_ = [('NextEntryOffset', ctypes.c_uint32),
-                ('Action', ctypes.c_uint32),
-                ('FileNameLength', ctypes.c_uint32),
-                ('Filename', ctypes.c_wchar)]
+if sys.platform == 'win32':
+    ReadDirectoryChangesW = ctypes.windll.kernel32.ReadDirectoryChangesW
+    ReadDirectoryChangesW.restype = ctypes.c_uint32
+    ReadDirectoryChangesW.argtypes  = [
+        ctypes.c_void_p,     # HANDLE hDirectory
+        ctypes.c_void_p,     # LPVOID lpBuffer
+        ctypes.c_uint32,     # DWORD nBufferLength
+        ctypes.c_uint32,     # BOOL bWatchSubtree
+        ctypes.c_uint32,     # DWORD dwNotifyFilter
+        ctypes.POINTER(ctypes.c_uint32),  # LPDWORD lpBytesReturned
+        ctypes.c_void_p,     # LPOVERLAPPED lpOverlapped
+        ctypes.c_void_p      # LPOVERLAPPED_COMPLETION_ROUTINE lpCompletionRoutine
+    ]
+    try:
+        from _winapi import (CreateFile, CloseHandle, GetLastError, ExitProcess,
+                             WaitForSingleObject, INFINITE, OPEN_EXISTING)
+    except ImportError:
+        CreateFile = ctypes.windll.kernel32.CreateFileW
+        CreateFile.restype = ctypes.c_void_p
+        CreateFile.argtypes  = [
+            ctypes.c_wchar_p,     # lpFilename
+            ctypes.c_uint32,      # dwDesiredAccess
+            ctypes.c_uint32,      # dwShareMode
+            ctypes.c_void_p,      # LPSECURITY_ATTRIBUTES,
+            ctypes.c_uint32,      # dwCreationDisposition,
+            ctypes.c_uint32,      # dwFlagsAndAttributes,
+            ctypes.c_void_p       # hTemplateFile
+        ]
+
+        CloseHandle = ctypes.windll.kernel32.CloseHandle
+        CloseHandle.argtypes = [ctypes.c_void_p]
+
+        GetLastError = ctypes.windll.kernel32.GetLastError
+        GetLastError.restype = ctypes.c_uint32
+
+        ExitProcess = ctypes.windll.kernel32.ExitProcess
+        ExitProcess.restype = ctypes.c_void_p
+        ExitProcess.argtypes  = [ctypes.c_uint32]
+
+        WaitForSingleObject = ctypes.windll.kernel32.WaitForSingleObject
+        WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        WaitForSingleObject.restype = ctypes.c_uint32
+
+        OPEN_EXISTING = 3
+        INFINITE = -1
+
+    FILE_LIST_DIRECTORY = 1
+    FILE_SHARE_READ = 0x00000001
+    FILE_SHARE_WRITE = 0x00000002
+    FILE_SHARE_DELETE = 0x00000004
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    MAX_PATH = 260
+    FILE_NOTIFY_CHANGE_LAST_WRITE  = 0x10
+    ERROR_NOTIFY_ENUM_DIR = 1022
+    INVALID_HANDLE_VALUE = 0xFFFFFFFF
+
+    class FILE_NOTIFY_INFORMATION(ctypes.Structure):
+        _fields_ = [('NextEntryOffset', ctypes.c_uint32),
+                    ('Action', ctypes.c_uint32),
+                    ('FileNameLength', ctypes.c_uint32),
+                    ('Filename', ctypes.c_wchar)]
+else:
+    # Only used to exit quickly from other threads
+    ExitProcess = os._exit
 
 _ON_EXIT_TASKS = None
 def run_exit_tasks():
     global _ON_EXIT_TASKS
     maybe_log("Running on_exit tasks")
+    # Pass queued messages to Application Insights before it is flushed
+    flush_log()
     while _ON_EXIT_TASKS:
         tasks, _ON_EXIT_TASKS = _ON_EXIT_TASKS, []
         for t in tasks:
@@ -478,6 +1084,7 @@ def run_exit_tasks():
                 t()
             except Exception:
                 maybe_log("Error in exit task: " + traceback.format_exc())
+    flush_log()
 
 def on_exit(task):
     global _ON_EXIT_TASKS
@@ -496,87 +1103,284 @@ def on_exit(task):
             start_new_thread(_wait_for_exit, ())
     _ON_EXIT_TASKS.append(task)
 
-def start_file_watcher(path, restart_regex):
-    if restart_regex is None:
-        restart_regex = ".*((\\.py)|(\\.config))$"
-    elif not restart_regex:
-        # restart regex set to empty string, no restart behavior
-        return
-    
-    def enum_changes(path):
+def scan_files(path, restart):
+    """Returns the modification time and size of each file under path whose
+    relative name matches restart."""
+    files = {}
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(full_path, path)
+            if restart.match(rel_path):
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                files[rel_path] = (st.st_mtime, st.st_size)
+    return files
+
+def changed_files(before, after):
+    """Returns the names of files that were added, removed or modified
+    between two results of scan_files."""
+    changed = [name for name, info in after.items() if before.get(name) != info]
+    changed.extend(name for name in before if name not in after)
+    return changed
+
+class Win32FileWatcher(object):
+    """Watches for changes using ReadDirectoryChangesW."""
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = CreateFile(
+            path,
+            FILE_LIST_DIRECTORY,
+            FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+            0,
+            OPEN_EXISTING,
+            FILE_FLAG_BACKUP_SEMANTICS,
+            0,
+        )
+        if not self.handle or self.handle == INVALID_HANDLE_VALUE:
+            raise OSError('Unable to open %s' % path)
+
+    def changes(self):
         """Returns a generator that blocks until a change occurs, then yields
         the filename of the changed file.
 
-        Yields an empty string and stops if the buffer overruns, indicating that
-        too many files were changed."""
-
+        Yields an empty string if the buffer overruns, indicating that too
+        many files were changed to report them individually."""
         buffer = ctypes.create_string_buffer(32 * 1024)
         bytes_ret = ctypes.c_uint32()
 
         try:
-            the_dir = CreateFile(
-                path, 
-                FILE_LIST_DIRECTORY, 
-                FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-                0,
-                OPEN_EXISTING,
-                FILE_FLAG_BACKUP_SEMANTICS,
-                0,
-            )
-        except OSError:
-            maybe_log("Unable to create watcher")
-            return
-
-        if not the_dir or the_dir == INVALID_HANDLE_VALUE:
-            maybe_log("Unable to create watcher")
-            return
+            while True:
+                ret_code = ReadDirectoryChangesW(
+                    self.handle,
+                    buffer,
+                    ctypes.sizeof(buffer),
+                    True,
+                    FILE_NOTIFY_CHANGE_LAST_WRITE,
+                    ctypes.byref(bytes_ret),
+                    None,
+                    None,
+                )
+
+                if ret_code:
+                    cur_pointer = ctypes.addressof(buffer)
+                    while True:
+                        fni = ctypes.cast(cur_pointer, ctypes.POINTER(FILE_NOTIFY_INFORMATION))
+                        # FileName is not null-terminated, so specifying length is mandatory.
+                        filename = ctypes.wstring_at(cur_pointer + 12, fni.contents.FileNameLength // 2)
+                        yield filename
+                        if fni.contents.NextEntryOffset == 0:
+                            break
+                        cur_pointer = cur_pointer + fni.contents.NextEntryOffset
+                elif GetLastError() == ERROR_NOTIFY_ENUM_DIR:
+                    yield ''
+                else:
+                    raise OSError('ReadDirectoryChangesW failed with error %s' % GetLastError())
+        finally:
+            CloseHandle(self.handle)
+
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_CLOEXEC      = 0o2000000
+
+#struct inotify_event {
+#   int      wd;
+#   uint32_t mask;
+#   uint32_t cookie;
+#   uint32_t len;
+#   char     name[];
+#};
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class InotifyFileWatcher(object):
+    """Watches for changes using inotify on Linux. Every directory under the
+    path is watched, including directories created later."""
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    def __init__(self, path):
+        import ctypes.util
+        self.path = path
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.add_tree(path)
+
+    def add_tree(self, dir_path):
+        for dirpath, _, _ in os.walk(dir_path):
+            name = dirpath if isinstance(dirpath, bytes) else dirpath.encode(sys.getfilesystemencoding())
+            wd = self.libc.inotify_add_watch(self.fd, name, self.mask)
+            if wd >= 0:
+                self.watches[wd] = dirpath
+            elif dirpath == self.path or ctypes.get_errno() != errno.ENOENT:
+                # Subdirectories may be removed while we walk, but anything
+                # else means we cannot rely on inotify.
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % dirpath)
+
+    def changes(self):
+        """Returns a generator that blocks until a change occurs, then yields
+        the filename of the changed file relative to the watched path.
 
+        Yields an empty string if events were lost or may have been missed."""
+        try:
+            while True:
+                data = os.read(self.fd, 64 * 1024)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                    offset += INOTIFY_EVENT.size
+                    name = data[offset:offset + name_len].rstrip(b'\0')
+                    offset += name_len
+
+                    if mask & IN_Q_OVERFLOW:
+                        yield ''
+                        continue
+                    dir_path = self.watches.get(wd)
+                    if dir_path is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        del self.watches[wd]
+                        continue
+
+                    if not isinstance(name, str):
+                        name = to_str(name)
+                    full_path = os.path.join(dir_path, name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            self.add_tree(full_path)
+                            # Files may have been added before the directory
+                            # was watched
+                            yield ''
+                        elif mask & IN_MOVED_FROM:
+                            # Files in the directory were moved with it
+                            yield ''
+                        continue
+                    yield os.path.relpath(full_path, self.path)
+        finally:
+            os.close(self.fd)
+
+class PollingFileWatcher(object):
+    """Watches for changes by periodically checking the modification time and
+    size of each file that matches restart."""
+
+    def __init__(self, path, restart, interval=2.0):
+        self.path = path
+        self.restart = restart
+        self.interval = interval
+
+    def changes(self):
+        before = scan_files(self.path, self.restart)
         while True:
-            ret_code = ReadDirectoryChangesW(
-                the_dir, 
-                buffer, 
-                ctypes.sizeof(buffer), 
-                True, 
-                FILE_NOTIFY_CHANGE_LAST_WRITE,
-                ctypes.byref(bytes_ret),
-                None,
-                None,
-            )
+            time.sleep(self.interval)
+            after = scan_files(self.path, self.restart)
+            for filename in changed_files(before, after):
+                yield filename
+            before = after
+
+def create_file_watcher(path, restart):
+    """Returns the native file watcher for this platform, or a polling file
+    watcher if it is not available."""
+    try:
+        if sys.platform == 'win32':
+            return Win32FileWatcher(path)
+        if sys.platform.startswith('linux'):
+            return InotifyFileWatcher(path)
+    except Exception:
+        maybe_log('Unable to create watcher, checking for changes periodically instead: ' +
+                  traceback.format_exc())
+    return PollingFileWatcher(path, restart)
+
+DEFAULT_RESTART_DEBOUNCE = 1.0
+
+def start_file_watcher(path, restart_regex, debounce=None, drain_timeout=None, on_change=None):
+    if restart_regex is None:
+        restart_regex = ".*((\\.py)|(\\.config))$"
+    elif not restart_regex:
+        # restart regex set to empty string, no restart behavior
+        return
 
-            if ret_code:
-                cur_pointer = ctypes.addressof(buffer)
-                while True:
-                    fni = ctypes.cast(cur_pointer, ctypes.POINTER(FILE_NOTIFY_INFORMATION))
-                    # FileName is not null-terminated, so specifying length is mandatory.
-                    filename = ctypes.wstring_at(cur_pointer + 12, fni.contents.FileNameLength // 2)
-                    yield filename
-                    if fni.contents.NextEntryOffset == 0:
-                        break
-                    cur_pointer = cur_pointer + fni.contents.NextEntryOffset
-            elif GetLastError() == ERROR_NOTIFY_ENUM_DIR:
-                CloseHandle(the_dir)
-                yield ''
+    try:
+        debounce = float(debounce)
+    except (TypeError, ValueError):
+        debounce = DEFAULT_RESTART_DEBOUNCE
+
+    log('wfastcgi.py will restart when files in %s are changed: %s' % (path, restart_regex))
+    restart = re.compile(restart_regex)
+    changes = Queue()
+
+    def pump(watcher):
+        """Passes changes from the watcher to the queue, switching to polling
+        if the native watcher fails."""
+        while True:
+            try:
+                for filename in watcher.changes():
+                    changes.put(filename)
+            except Exception:
+                maybe_log('File watcher failed: ' + traceback.format_exc())
+            if isinstance(watcher, PollingFileWatcher):
                 return
+            watcher = PollingFileWatcher(path, restart)
+            # Changes may have been missed while switching
+            changes.put('')
+
+    def watcher():
+        # Snapshot the matching files so that overflows can be checked by
+        # rescanning, rather than assuming a matching file has changed.
+        files = scan_files(path, restart)
+        while True:
+            filename = changes.get()
+            if filename:
+                if not restart.match(filename):
+                    continue
+                reason = '%s has changed, matching %s' % (filename, restart_regex)
             else:
-                CloseHandle(the_dir)
+                new_files = scan_files(path, restart)
+                changed = changed_files(files, new_files)
+                files = new_files
+                if not changed:
+                    continue
+                reason = '%s has changed, matching %s' % (changed[0], restart_regex)
+
+            # Wait for a burst of changes, such as a deployment, to finish
+            # so that the new process starts with all of them.
+            deadline = time.time() + debounce * 10
+            while time.time() < deadline:
+                try:
+                    changes.get(timeout=debounce)
+                except Empty:
+                    break
+
+            if on_change is not None:
+                on_change(reason)
                 return
 
-    log('wfastcgi.py will restart when files in %s are changed: %s' % (path, restart_regex))
-    def watcher(path, restart):
-        for filename in enum_changes(path):
-            if not filename:
-                log('wfastcgi.py exiting because the buffer was full')
-                run_exit_tasks()
-                ExitProcess(0)
-            elif restart.match(filename):
-                log('wfastcgi.py exiting because %s has changed, matching %s' % (filename, restart_regex))
-                # we call ExitProcess directly to quickly shutdown the whole process
-                # because sys.exit(0) won't have an effect on the main thread.
-                run_exit_tasks()
-                ExitProcess(0)
+            log('wfastcgi.py restarting because ' + reason)
+            # Let running requests finish rather than failing them. New
+            # connections are not accepted.
+            running = drain_requests(get_drain_timeout(drain_timeout))
+            if running:
+                log('wfastcgi.py exiting with %s requests still running' % running)
+            else:
+                log('wfastcgi.py exiting')
+            # we call ExitProcess directly to quickly shutdown the whole process
+            # because sys.exit(0) won't have an effect on the main thread.
+            run_exit_tasks()
+            ExitProcess(0)
 
-    restart = re.compile(restart_regex)
-    start_new_thread(watcher, (path, restart))
+    start_new_thread(pump, (create_file_watcher(path, restart),))
+    start_new_thread(watcher, ())
 
 def get_wsgi_handler(handler_name):
     if not handler_name:
@@ -644,6 +1448,290 @@ def read_wsgi_handler(physical_path):
 
     return env, handler
 
+class Histogram(object):
+    """Counts values in buckets that are within 1/8 of each other, so that
+    percentiles are accurate to about 12% for values of any size."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value):
+        if value < 16:
+            return value
+        shift = value.bit_length() - 4
+        return (shift << 3) + (value >> shift)
+
+    @staticmethod
+    def bucket_value(bucket):
+        """returns the smallest value counted in bucket"""
+        if bucket < 16:
+            return bucket
+        shift = (bucket >> 3) - 1
+        return (8 + (bucket & 7)) << shift
+
+    def add(self, value):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self.bucket_value(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total // self.count,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+            'max': self.max,
+        }
+
+class Metrics(object):
+    """Counters and histograms of where time goes in each request. Times are
+    in microseconds."""
+
+    # The number of slowest requests to remember
+    slowest_count = 10
+
+    HISTOGRAMS = (
+        # from FCGI_BEGIN_REQUEST until the last FCGI_PARAMS record
+        'receive_params',
+        # time spent by the application waiting for wsgi.input
+        'wait_input',
+        # time spent running the application, including wait_input but not
+        # send_response
+        'handler',
+        # time spent writing the response
+        'send_response',
+        # from FCGI_BEGIN_REQUEST until the first response record is written
+        'time_to_first_byte',
+        # from FCGI_BEGIN_REQUEST until FCGI_END_REQUEST is written
+        'total',
+        # bytes of response content
+        'bytes_out',
+    )
+
+    # Requests are counted on the request thread if this many are waiting
+    max_pending = 8192
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Appending to and popping from a deque are atomic, so requests are
+        # added without taking the lock
+        self._pending = deque()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.statuses = {}
+        self.histograms = dict((name, Histogram()) for name in self.HISTOGRAMS)
+        self.slowest = []
+
+    def add_request(self, response, failed):
+        """records the times of a completed request. This only saves them,
+        and they are counted later by count_pending so that requests are not
+        slowed down."""
+        record = response.record
+        params = record.params
+        self._pending.append((
+            _clock(),
+            record.started,
+            record.params_received,
+            response.handler_started,
+            response.first_byte,
+            response.send_time,
+            params['wsgi.input'].wait_time,
+            response.bytes_sent,
+            response.status,
+            failed,
+            params.get('REQUEST_METHOD', ''),
+            params.get('wsgi.path_info'),
+        ))
+        if len(self._pending) >= self.max_pending:
+            self.count_pending()
+
+    def count_pending(self):
+        with self._lock:
+            # Only the requests pending now are counted. Any added while
+            # counting stay queued for the next call.
+            pending = self._pending
+            popleft = pending.popleft
+            histograms = self.histograms
+            receive_params = histograms['receive_params'].add
+            wait_input = histograms['wait_input'].add
+            handler = histograms['handler'].add
+            send_response = histograms['send_response'].add
+            time_to_first_byte = histograms['time_to_first_byte'].add
+            total_time = histograms['total'].add
+            bytes_out = histograms['bytes_out'].add
+            slowest = self.slowest
+
+            for _ in range(len(pending)):
+                (end, started, params_received, handler_started, first_byte, send_time,
+                 wait_time, bytes_sent, status, failed, method, path) = popleft()
+                handler_started = handler_started or end
+                total = int((end - started) * 1e6)
+                receive_params(max(int(((params_received or handler_started) - started) * 1e6), 0))
+                wait_input(int(wait_time * 1e6))
+                handler(max(int((end - handler_started - send_time) * 1e6), 0))
+                send_response(int(send_time * 1e6))
+                time_to_first_byte(int(((first_byte or end) - started) * 1e6))
+                total_time(total)
+                bytes_out(bytes_sent)
+
+                self.requests += 1
+                if failed:
+                    self.errors += 1
+                self.bytes_out += bytes_sent
+                status = (status or '500')[:1] + 'xx'
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+                if len(slowest) < self.slowest_count or total > slowest[-1][0]:
+                    # Decoded the same way on Python 2 and 3
+                    path = (path or bytes()).decode('iso-8859-1')
+                    slowest.append((total, method, path))
+                    slowest.sort(reverse=True)
+                    del slowest[self.slowest_count:]
+
+    def to_json(self):
+        self.count_pending()
+        with self._lock:
+            uptime = time.time() - self.started
+            return json.dumps({
+                'pid': os.getpid(),
+                'uptime': uptime,
+                'requests': self.requests,
+                'requests_per_second': self.requests / uptime if uptime else 0,
+                'errors': self.errors,
+                'bytes_out': self.bytes_out,
+                'statuses': self.statuses,
+                'histograms': dict((name, h.to_dict()) for name, h in self.histograms.items()),
+                'slowest': [
+                    {'total': total, 'method': method, 'path': path}
+                    for total, method, path in self.slowest
+                ],
+            }, sort_keys=True)
+
+# The metrics for this process, or None if WSGI_METRICS_PATH is not set
+_METRICS = None
+
+# The FCGI_GET_VALUES name that returns the metrics as JSON
+WFASTCGI_METRICS = "WFASTCGI_METRICS"
+
+def get_metrics_path():
+    """returns the file that metrics are written to, with {pid} replaced by
+    the process ID, or None if metrics are not collected"""
+    path = os.getenv('WSGI_METRICS_PATH')
+    return path.replace('{pid}', str(os.getpid())) if path else None
+
+def write_metrics():
+    """writes the metrics to WSGI_METRICS_PATH, replacing its contents in a
+    single step so that readers never see a partial file"""
+    path = get_metrics_path()
+    if _METRICS is None or not path:
+        return
+    temp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(_METRICS.to_json())
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # Windows does not replace existing files when renaming
+        os.remove(path)
+        os.rename(temp_path, path)
+
+def start_metrics():
+    """starts collecting metrics if WSGI_METRICS_PATH is set, writing them
+    every WSGI_METRICS_INTERVAL seconds"""
+    global _METRICS
+    if not os.getenv('WSGI_METRICS_PATH'):
+        return
+    first = _METRICS is None
+    _METRICS = Metrics()
+    try:
+        interval = float(os.getenv('WSGI_METRICS_INTERVAL', ''))
+    except ValueError:
+        interval = DEFAULT_METRICS_INTERVAL
+
+    metrics = _METRICS
+    def writer():
+        next_write = time.time() + interval
+        while _METRICS is metrics:
+            # Count requests regularly, so that few are waiting when the
+            # metrics are requested
+            time.sleep(min(interval, 1.0))
+            metrics.count_pending()
+            if time.time() < next_write:
+                continue
+            next_write += interval
+            try:
+                write_metrics()
+            except Exception:
+                maybe_log('Error writing metrics: ' + traceback.format_exc())
+    start_new_thread(writer, ())
+    if first:
+        on_exit(write_metrics)
+
+DEFAULT_METRICS_INTERVAL = 60.0
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper for a request. Iterating it reads the file in
+    blocks, as PEP 3333 requires, but handle_response.send_file sends
+    regular files without creating an object for each block."""
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    next = __next__
+
+    def open_reader(self):
+        """returns an unbuffered reader positioned where the file is, or None
+        if it is not a regular file"""
+        try:
+            fd = self.filelike.fileno()
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                return None
+            position = self.filelike.tell()
+        except Exception:
+            return None
+        reader = io.open(fd, 'rb', buffering=0, closefd=False)
+        reader.seek(position)
+        return reader
+
+# Holds the buffer that each thread reads files into
+_FILE_BUFFER = threading.local()
+# Large enough for the writer to send several full records at once
+FILE_BUFFER_SIZE = FCGI_MAX_CONTENT_LEN * 4
+
 class handle_response(object):
     """A context manager for handling the response. This will ensure that
     exceptions in the handler are correctly reported, and the FastCGI request is
@@ -659,18 +1747,23 @@ class handle_response(object):
         self.fatal_errors = False
         self.physical_path = ''
         self.header_bytes = None
+        self.headers = None
         self.sent_headers = False
+        self.sent_errors = False
+        self.writer = RecordWriter(stream, record.req_id)
+        # Only updated when collecting metrics
+        self.status = None
+        self.handler_started = None
+        self.first_byte = None
+        self.bytes_sent = 0
+        self.send_time = 0.0
 
     def __enter__(self):
         record = self.record
-        record.params['wsgi.input'].seek(0)
         if 'wsgi.data' in record.params:
             record.params['wsgi.data'].seek(0)
-        record.params['wsgi.version'] = (1, 0)
+        record.params.update(_REQUEST_TEMPLATE.environ)
         record.params['wsgi.url_scheme'] = 'https' if record.params.get('HTTPS', '').lower() == 'on' else 'http'
-        record.params['wsgi.multiprocess'] = True
-        record.params['wsgi.multithread'] = False
-        record.params['wsgi.run_once'] = False
 
         self.physical_path = record.params.get('APPL_PHYSICAL_PATH', os.path.dirname(__file__))
 
@@ -687,6 +1780,7 @@ class handle_response(object):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        global _REQUEST_COUNT
         # Send any error message on FCGI_STDERR.
         if exc_type and exc_type is not _ExitException:
             error_msg = "%s:\n\n%s\n\nStdOut: %s\n\nStdErr: %s" % (
@@ -704,10 +1798,25 @@ class handle_response(object):
             maybe_log(error_msg)
 
         # End the request. This has to run in both success and failure cases.
-        self.send(FCGI_END_REQUEST, zero_bytes(8), streaming=False)
-        
-        # Remove the request from our global dict
-        del _REQUESTS[self.record.req_id]
+        try:
+            if not self.sent_headers:
+                self.send(FCGI_STDOUT, zero_bytes(0))
+            # Terminate the output streams and end the request in a single write
+            self.writer.add(FCGI_STDOUT, zero_bytes(0))
+            if self.sent_errors:
+                self.writer.add(FCGI_STDERR, zero_bytes(0))
+            self.writer.add(FCGI_END_REQUEST, zero_bytes(8))
+            self.writer.flush()
+            if self.record.started is not None:
+                _METRICS.add_request(self, exc_type is not None)
+        finally:
+            # Remove the request from its connection, even if the connection
+            # has failed
+            with _REQUESTS_CHANGED:
+                del self.stream.requests[self.record.req_id]
+                _REQUEST_COUNT -= 1
+                _REQUESTS_CHANGED.notify_all()
+            self.record.params['wsgi.input'].close()
         
         # Suppress all exceptions unless requested
         return not self.fatal_errors
@@ -735,6 +1844,8 @@ class handle_response(object):
 
         if not isinstance(status, str):
             status = wsgi_decode(status)
+        self.status = status
+        self.headers = headers
         header_text = 'Status: %s\r\n' % status
         if headers:
             header_text += ''.join('%s: %s\r\n' % handle_response._decode_header(*i) for i in headers)
@@ -742,22 +1853,643 @@ class handle_response(object):
 
         return lambda content: self.send(FCGI_STDOUT, content)
 
-    def send(self, resp_type, content, streaming=True):
+    def send(self, resp_type, content):
         '''Sends part of the response.'''
+        if not isinstance(content, bytes):
+            raise TypeError("content must be encoded before sending: %r" % content)
+        self._send(resp_type, content)
+
+    def send_file(self, wrapper):
+        """Sends the file from a wsgi.file_wrapper by reading it into a buffer
+        that is reused for every block. Returns False without sending anything
+        if it is not a regular file."""
+        reader = wrapper.open_reader()
+        if reader is None:
+            return False
+
+        # Never send more than the application said it would
+        remaining = None
+        for key, value in self.headers or ():
+            key, value = handle_response._decode_header(key, value)
+            if key.lower() == 'content-length':
+                try:
+                    remaining = int(value)
+                except ValueError:
+                    pass
+
+        try:
+            buffer = _FILE_BUFFER.buffer
+        except AttributeError:
+            buffer = _FILE_BUFFER.buffer = memoryview(bytearray(FILE_BUFFER_SIZE))
+        with reader:
+            while remaining is None or remaining > 0:
+                if remaining is None or remaining >= len(buffer):
+                    read = reader.readinto(buffer)
+                else:
+                    read = reader.readinto(buffer[:remaining])
+                if not read:
+                    break
+                if remaining is not None:
+                    remaining -= read
+                # each block is written before the buffer is reused
+                self._send(FCGI_STDOUT, buffer[:read])
+        if not self.sent_headers:
+            self._send(FCGI_STDOUT, zero_bytes(0))
+        return True
+
+    def _send(self, resp_type, content):
         if not self.sent_headers:
             if not self.header_bytes:
                 raise Exception("start_response has not yet been called")
 
+            # The headers are written together with the first content
             self.sent_headers = True
-            send_response(self.stream, self.record.req_id, FCGI_STDOUT, self.header_bytes)
+            self.writer.add(FCGI_STDOUT, self.header_bytes)
             self.header_bytes = None
 
-        return send_response(self.stream, self.record.req_id, resp_type, content, streaming)
+        if content:
+            if resp_type == FCGI_STDERR:
+                self.sent_errors = True
+            self.writer.add(resp_type, content)
+
+        # Each part is written before the application produces the next one,
+        # as required by PEP 3333.
+        if self.record.started is None:
+            self.writer.flush()
+            return
+
+        start = _clock()
+        self.writer.flush()
+        end = _clock()
+        self.send_time += end - start
+        self.bytes_sent += len(content)
+        if self.first_byte is None:
+            self.first_byte = end
+
+# The number of requests that have begun on all connections
+_REQUEST_COUNT = 0
+# Held while adding or removing requests, and notified when one is removed
+_REQUESTS_CHANGED = threading.Condition()
+# Set when restarting, after which new connections are not accepted
+_DRAINING = False
+# Set when restarting if requests that begin while draining are refused as
+# overloaded, rather than run before the process exits
+_REFUSE_REQUESTS = False
+# Connections accepted from a listening socket
+_CONNECTIONS = set()
+# The number of connections that are served at the same time
+_MAX_CONNS = 1
+
+def stop_accepting():
+    """Stops accepting connections, and closes connections that are not
+    running a request. New requests on the remaining connections are refused
+    if WSGI_RESTART_REFUSE_REQUESTS is set.
+
+    IIS shows a refused request as an error rather than sending it to
+    another process, so by default they are run."""
+    global _DRAINING, _REFUSE_REQUESTS
+    with _REQUESTS_CHANGED:
+        _DRAINING = True
+        _REFUSE_REQUESTS = os.getenv('WSGI_RESTART_REFUSE_REQUESTS', '').strip().lower() in ('1', 'true')
+        for fcgi_stream in _CONNECTIONS:
+            if not fcgi_stream.requests:
+                try:
+                    fcgi_stream.stream.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+def drain_requests(timeout):
+    """Stops accepting new connections and waits up to timeout seconds for
+    the requests that have started to finish, or without a limit if
+    timeout is None. Returns the number of requests that are still running."""
+    stop_accepting()
+    deadline = None if timeout is None else time.time() + timeout
+    with _REQUESTS_CHANGED:
+        while _REQUEST_COUNT:
+            if deadline is None:
+                _REQUESTS_CHANGED.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            _REQUESTS_CHANGED.wait(remaining)
+        return _REQUEST_COUNT
+
+def get_drain_timeout(value):
+    """returns the number of seconds to wait for running requests when
+    restarting"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return DEFAULT_DRAIN_TIMEOUT
+
+DEFAULT_DRAIN_TIMEOUT = 30.0
+
+class RequestTemplate(object):
+    """The parts of the environ that are the same for every request, and the
+    SCRIPT_NAME settings, which are read once rather than per request."""
+
+    def __init__(self, multithread=False):
+        self.environ = {
+            'wsgi.version': (1, 0),
+            'wsgi.multiprocess': True,
+            'wsgi.multithread': multithread,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+
+        # SCRIPT_NAME + PATH_INFO is supposed to be the full path
+        # (http://www.python.org/dev/peps/pep-0333/) but by default
+        # (http://msdn.microsoft.com/en-us/library/ms525840(v=vs.90).aspx)
+        # IIS is sending us the full URL in PATH_INFO, so we need to
+        # clear the script name
+        self.clear_script_name = 'AllowPathInfoForScriptMappings' not in os.environ
+
+        # correct SCRIPT_NAME and PATH_INFO if we are told what our SCRIPT_NAME should be
+        self.script_name = os.environ.get('SCRIPT_NAME')
+        if self.script_name is not None:
+            self.script_name_lower = self.script_name.lower()
+            self.raw_script_name = wsgi_encode(self.script_name)
+
+    def apply_script_name(self, params):
+        if self.clear_script_name:
+            params['SCRIPT_NAME'] = ''
+            params['wsgi.script_name'] = wsgi_encode('')
+
+        if self.script_name is not None and params['PATH_INFO'].lower().startswith(self.script_name_lower):
+            params['SCRIPT_NAME'] = self.script_name
+            params['PATH_INFO'] = params['PATH_INFO'][len(self.script_name):]
+            params['wsgi.script_name'] = self.raw_script_name
+            params['wsgi.path_info'] = wsgi_encode(params['PATH_INFO'])
+
+# Replaced once the application settings have been loaded
+_REQUEST_TEMPLATE = RequestTemplate()
+
+# The pool running requests when WSGI_THREADS is set, or None when requests
+# run one at a time on the main thread.
+_WORKERS = None
+
+class _WorkerPool(object):
+    """A fixed number of threads that run requests handed to them by the main
+    thread, which keeps reading records for all requests."""
+
+    def __init__(self, count, target):
+        self.count = count
+        self._target = target
+        self._queue = Queue()
+        for _ in range(count):
+            start_new_thread(self._worker, ())
+
+    def submit(self, *args):
+        self._queue.put(args)
+
+    def _worker(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self._target(*args)
+            except Exception:
+                maybe_log('Unhandled exception in wfastcgi.py worker: ' + traceback.format_exc())
+
+class _DiscardOutput(object):
+    """Output for threads that are not running a request."""
+    def write(self, text):
+        pass
+
+    def writelines(self, lines):
+        pass
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''
+
+class _RequestOutput(object):
+    """Replaces sys.stdout or sys.stderr while requests run on worker threads,
+    and writes to the buffer of the request running on the current thread."""
+
+    _DISCARD = _DiscardOutput()
+
+    def __init__(self, local, name):
+        self._local = local
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(self._local, self._name, self._DISCARD), attr)
 
-_REQUESTS = {}
+_REQUEST_OUTPUT = threading.local()
+
+def get_thread_count():
+    """returns the number of threads that run requests, or 0 to run them on
+    the main thread"""
+    try:
+        count = int(os.getenv('WSGI_THREADS', ''))
+    except ValueError:
+        return 0
+    return count if count > 1 else 0
+
+def capture_thread_output():
+    """captures output separately for the request running on each thread"""
+    sys.stdout = sys.__stdout__ = _RequestOutput(_REQUEST_OUTPUT, 'stdout')
+    sys.stderr = sys.__stderr__ = _RequestOutput(_REQUEST_OUTPUT, 'stderr')
+
+def start_workers(count, handler):
+    global _WORKERS, _REQUEST_TEMPLATE
+    _REQUEST_TEMPLATE = RequestTemplate(multithread=True)
+    capture_thread_output()
+    _WORKERS = _WorkerPool(count, lambda stream, record: process_request(stream, record, handler))
+    log('wfastcgi.py running requests on %s threads' % count)
+
+def process_request(stream, record, handler):
+    """runs a request on a worker thread"""
+    # Buffers are not reused, as code may keep a reference to them after
+    # the request completes
+    output, errors = StringIO(), StringIO()
+    _REQUEST_OUTPUT.stdout = output
+    _REQUEST_OUTPUT.stderr = record.params['wsgi.errors'] = errors
+    try:
+        with handle_response(stream, record, output.getvalue, errors.getvalue) as response:
+            run_handler(record, response, handler)
+    finally:
+        del _REQUEST_OUTPUT.stdout, _REQUEST_OUTPUT.stderr
+
+def run_handler(record, response, handler):
+    """calls the WSGI handler and sends its response"""
+    _REQUEST_TEMPLATE.apply_script_name(record.params)
+    if record.started is not None:
+        response.handler_started = _clock()
+
+    # Send each part of the response to FCGI_STDOUT.
+    # Exceptions raised in the handler will be logged by the context
+    # manager and we will then wait for the next record.
+
+    result = handler(record.params, response.start)
+    try:
+        if isinstance(result, FileWrapper) and response.send_file(result):
+            return
+        for part in result:
+            if part:
+                response.send(FCGI_STDOUT, part)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+def serve_connection(fcgi_stream, run_request):
+    """runs requests from one connection on the current thread until the web
+    server closes it, or until the process is stopping"""
+    while True:
+        record = read_fastcgi_record(fcgi_stream)
+        if not record:
+            continue
+
+        run_request(fcgi_stream, record)
+
+        if not record.flags & FCGI_KEEP_CONN:
+            # the web server expects us to close the connection
+            return
+        if _DRAINING and not fcgi_stream.requests:
+            return
+
+def handle_connection(conn, run_request):
+    """serves an accepted connection and closes it"""
+    fcgi_stream = FastCgiStream(conn)
+    with _REQUESTS_CHANGED:
+        _CONNECTIONS.add(fcgi_stream)
+    try:
+        serve_connection(fcgi_stream, run_request)
+    except _ExitException:
+        # the web server closed the connection
+        pass
+    except EnvironmentError:
+        if not _DRAINING:
+            maybe_log('Connection failed: ' + traceback.format_exc())
+    finally:
+        with _REQUESTS_CHANGED:
+            _CONNECTIONS.discard(fcgi_stream)
+        conn.close()
+
+def accept_connection(listener):
+    """returns the next connection, or None if none arrived before the
+    listener timed out"""
+    try:
+        conn, _ = listener.accept()
+    except socket.timeout:
+        return None
+    except socket.error as ex:
+        if ex.args[0] != errno.EINTR:
+            raise
+        return None
+    conn.settimeout(None)
+    try:
+        # responses are written as several small records, which Nagle's
+        # algorithm would otherwise delay until the client acknowledges them
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error:
+        # not a TCP socket
+        pass
+    return conn
+
+# Web servers that start FastCGI applications themselves pass a listening
+# socket as stdin (http://www.fastcgi.com/devkit/doc/fcgi-spec.html#S2.2)
+FCGI_LISTENSOCK_FILENO = 0
+
+def get_listen_socket():
+    """returns the listening socket passed as stdin, or None if stdin is the
+    pipe used by IIS"""
+    if not hasattr(os, 'fork'):
+        return None
+    fd = os.dup(FCGI_LISTENSOCK_FILENO)
+    try:
+        try:
+            sock = socket.socket(fileno=fd)
+        except TypeError:
+            # Python 2 cannot detect the family of an existing socket
+            sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+    except (OSError, socket.error):
+        os.close(fd)
+        return None
+    try:
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+            return sock
+    except socket.error:
+        pass
+    sock.close()
+    return None
+
+def get_prefork_count():
+    """returns the number of worker processes to fork, or 0 to accept
+    connections in this process"""
+    try:
+        count = int(os.getenv('WSGI_PREFORK_WORKERS', ''))
+    except ValueError:
+        return 0
+    return max(count, 0)
+
+def _stop_worker(signum, frame):
+    stop_accepting()
+
+def run_worker(listener, handler, threads=0, drain_timeout=None):
+    """accepts connections until stopped, running their requests on this
+    thread, or on up to threads connection threads"""
+    global _MAX_CONNS, _REQUEST_TEMPLATE
+    # Wake up regularly to check whether we are stopping
+    listener.settimeout(1.0)
+
+    if not threads:
+        def run_request(stream, record):
+            # Buffers are not reused, as code may keep a reference to them
+            # after the request completes
+            output, errors = StringIO(), StringIO()
+            sys.stderr = sys.__stderr__ = record.params['wsgi.errors'] = errors
+            sys.stdout = sys.__stdout__ = output
+            with handle_response(stream, record, output.getvalue, errors.getvalue) as response:
+                run_handler(record, response, handler)
+
+        while not _DRAINING:
+            conn = accept_connection(listener)
+            if conn is not None:
+                handle_connection(conn, run_request)
+        return
+
+    _MAX_CONNS = threads
+    _REQUEST_TEMPLATE = RequestTemplate(multithread=True)
+    capture_thread_output()
+    slots = threading.BoundedSemaphore(threads)
+
+    def run_request(stream, record):
+        process_request(stream, record, handler)
+
+    def connection_thread(conn):
+        try:
+            handle_connection(conn, run_request)
+        finally:
+            slots.release()
+
+    log('wfastcgi.py accepting %s connections at a time' % threads)
+    while not _DRAINING:
+        slots.acquire()
+        conn = accept_connection(listener)
+        if conn is None:
+            slots.release()
+            continue
+        start_new_thread(connection_thread, (conn,))
+
+    running = drain_requests(drain_timeout)
+    if running:
+        log('wfastcgi.py stopping with %s requests still running' % running)
+
+class _PreforkPool(object):
+    """Forks worker processes that share the imported application and accept
+    connections on the same listening socket, and replaces any that exit."""
+
+    # Workers exiting sooner than this are assumed to be failing to start
+    min_lifetime = 1.0
+
+    def __init__(self, listener, count, handler, threads, drain_timeout):
+        self.listener = listener
+        self.count = count
+        self.handler = handler
+        self.threads = threads
+        self.drain_timeout = drain_timeout
+        self.workers = {}
+        self.restart_reason = None
+        self.stopping = False
+
+    def spawn(self):
+        flush_log()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+
+        # In the worker process
+        reset_log()
+        start_metrics()
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, _stop_worker)
+            # Interrupting the master from a terminal also reaches workers,
+            # which are stopped by the master instead
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            run_worker(self.listener, self.handler, self.threads, self.drain_timeout)
+        except _ExitException:
+            pass
+        except BaseException:
+            maybe_log('Unhandled exception in wfastcgi.py worker: ' + traceback.format_exc())
+            exit_code = 1
+        finally:
+            run_exit_tasks()
+            os._exit(exit_code)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def restart(self, reason):
+        self.restart_reason = reason
+        self.stopping = True
+
+    def reap(self):
+        """removes exited workers, returning how many exited too quickly"""
+        failed = 0
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno != errno.EINTR:
+                    raise
+                continue
+            if not pid:
+                break
+            started = self.workers.pop(pid, None)
+            if started is not None:
+                if time.time() - started < self.min_lifetime:
+                    failed += 1
+                if not self.stopping:
+                    log('wfastcgi.py worker %s exited' % pid)
+        return failed
+
+    def run(self, start_watcher=None):
+        """runs workers until stopped. start_watcher is called once the first
+        workers have been forked, so that they do not inherit the state of
+        threads that it starts."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # Objects imported so far will not be modified by the garbage
+        # collector, so their pages stay shared with the workers.
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        while not self.stopping:
+            if self.reap():
+                # Avoid forking continuously while the workers are failing
+                time.sleep(self.min_lifetime)
+            while len(self.workers) < self.count and not self.stopping:
+                self.spawn()
+            if start_watcher is not None:
+                # Workers forked to replace ones that exit are forked while
+                # the watcher threads run. They only use locks of their own
+                # and the log, which is reset in the worker.
+                start_watcher()
+                start_watcher = None
+            time.sleep(0.1)
+
+        # Let workers finish their running requests
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.drain_timeout
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.workers:
+            log('wfastcgi.py worker %s did not stop in time' % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        while self.workers:
+            pid, _ = os.waitpid(-1, 0)
+            self.workers.pop(pid, None)
+
+def create_listen_socket(address):
+    """creates a socket listening on address, which is either host:port or
+    the path of a Unix socket, optionally prefixed with unix:"""
+    if address.startswith('unix:') or address.startswith('/'):
+        path = address[5:] if address.startswith('unix:') else address
+        try:
+            # remove the socket left by a previous process
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    else:
+        host, _, port = address.rpartition(':')
+        family, socktype, proto, _, addr = socket.getaddrinfo(
+            host.strip('[]') or None,
+            int(port),
+            0,
+            socket.SOCK_STREAM,
+            0,
+            socket.AI_PASSIVE,
+        )[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(addr)
+    sock.listen(socket.SOMAXCONN)
+    log('wfastcgi.py listening on %s' % address)
+    return sock
+
+def restart_process(listener):
+    """replaces this process with a new one that accepts connections on the
+    same listening socket, so connections wait in its backlog until the new
+    process is ready"""
+    import subprocess
+    os.dup2(listener.fileno(), FCGI_LISTENSOCK_FILENO)
+    os.environ.pop('WSGI_LISTEN', None)
+    # Keep options such as -O, -W and -X that are not part of sys.argv
+    get_flags = getattr(subprocess, '_args_from_interpreter_flags', list)
+    os.execv(sys.executable, [sys.executable] + get_flags() + sys.argv)
+
+def serve_listener(listener):
+    """imports the application once and serves connections from listener,
+    optionally in forked worker processes"""
+    global _REQUEST_TEMPLATE
+    physical_path = os.getcwd()
+    sys.path[0] = '.'
+    log('wfastcgi.py %s initializing' % __version__)
+    env, handler = read_wsgi_handler(physical_path)
+    _REQUEST_TEMPLATE = RequestTemplate()
+
+    count = get_prefork_count()
+    threads = get_thread_count()
+    drain_timeout = get_drain_timeout(env.get('WSGI_RESTART_DRAIN_TIMEOUT'))
+    restart_reasons = []
+
+    if count:
+        pool = _PreforkPool(listener, count, handler, threads, drain_timeout)
+        on_change = pool.restart
+    else:
+        def on_change(reason):
+            restart_reasons.append(reason)
+            stop_accepting()
+
+    def start_watcher():
+        start_file_watcher(
+            physical_path,
+            env.get('WSGI_RESTART_FILE_REGEX'),
+            env.get('WSGI_RESTART_DEBOUNCE'),
+            on_change=on_change,
+        )
+
+    if count:
+        log('wfastcgi.py %s initialized with %s worker processes' % (__version__, count))
+        pool.run(start_watcher)
+        if pool.restart_reason:
+            restart_reasons.append(pool.restart_reason)
+    else:
+        start_watcher()
+        signal.signal(signal.SIGTERM, _stop_worker)
+        start_metrics()
+        log('wfastcgi.py %s initialized' % __version__)
+        run_worker(listener, handler, threads, drain_timeout)
+
+    if restart_reasons:
+        log('wfastcgi.py restarting because ' + restart_reasons[0])
+        run_exit_tasks()
+        restart_process(listener)
 
 def main():
+    global _REQUEST_TEMPLATE
     initialized = False
+    threads = 0
     log('wfastcgi.py %s started' % __version__)
     log('Python version: %s' % sys.version)
 
@@ -768,14 +2500,36 @@ def main():
             msvcrt.setmode(fcgi_stream.fileno(), os.O_BINARY)
         except ImportError:
             pass
+        listen_address = os.getenv('WSGI_LISTEN')
+        if listen_address and not hasattr(os, 'fork'):
+            # connections are read and written as file descriptors, which
+            # Windows sockets are not
+            log('WSGI_LISTEN is only supported on Linux and other POSIX platforms')
+            return
+        if listen_address:
+            listener = create_listen_socket(listen_address)
+        else:
+            listener = get_listen_socket()
+        if listener is not None:
+            serve_listener(listener)
+            return
+
+        fcgi_stream = FastCgiStream(fcgi_stream)
 
         while True:
             record = read_fastcgi_record(fcgi_stream)
             if not record:
                 continue
 
-            errors = sys.stderr = sys.__stderr__ = record.params['wsgi.errors'] = StringIO()
-            output = sys.stdout = sys.__stdout__ = StringIO()
+            if _WORKERS is not None:
+                _WORKERS.submit(fcgi_stream, record)
+                continue
+
+            # Buffers are not reused, as code may keep a reference to them
+            # after the request completes
+            output, errors = StringIO(), StringIO()
+            sys.stderr = sys.__stderr__ = record.params['wsgi.errors'] = errors
+            sys.stdout = sys.__stdout__ = output
 
             with handle_response(fcgi_stream, record, output.getvalue, errors.getvalue) as response:
                 if not initialized:
@@ -790,7 +2544,12 @@ def main():
                     env, handler = read_wsgi_handler(response.physical_path)
 
                     response.error_message = 'Error occurred starting file watcher'
-                    start_file_watcher(response.physical_path, env.get('WSGI_RESTART_FILE_REGEX'))
+                    start_file_watcher(
+                        response.physical_path,
+                        env.get('WSGI_RESTART_FILE_REGEX'),
+                        env.get('WSGI_RESTART_DEBOUNCE'),
+                        env.get('WSGI_RESTART_DRAIN_TIMEOUT'),
+                    )
 
                     # Enable debugging if possible. Default to local-only, but
                     # allow a web.config to override where we listen
@@ -820,37 +2579,18 @@ def main():
 
                     log('wfastcgi.py %s initialized' % __version__)
                     initialized = True
-
-                os.environ.update(env)
-
-                # SCRIPT_NAME + PATH_INFO is supposed to be the full path
-                # (http://www.python.org/dev/peps/pep-0333/) but by default
-                # (http://msdn.microsoft.com/en-us/library/ms525840(v=vs.90).aspx)
-                # IIS is sending us the full URL in PATH_INFO, so we need to
-                # clear the script name here
-                if 'AllowPathInfoForScriptMappings' not in os.environ:
-                    record.params['SCRIPT_NAME'] = ''
-                    record.params['wsgi.script_name'] = wsgi_encode('')
-
-                # correct SCRIPT_NAME and PATH_INFO if we are told what our SCRIPT_NAME should be
-                if 'SCRIPT_NAME' in os.environ and record.params['PATH_INFO'].lower().startswith(os.environ['SCRIPT_NAME'].lower()):
-                    record.params['SCRIPT_NAME'] = os.environ['SCRIPT_NAME']
-                    record.params['PATH_INFO'] = record.params['PATH_INFO'][len(record.params['SCRIPT_NAME']):]
-                    record.params['wsgi.script_name'] = wsgi_encode(record.params['SCRIPT_NAME'])
-                    record.params['wsgi.path_info'] = wsgi_encode(record.params['PATH_INFO'])
-
-                # Send each part of the response to FCGI_STDOUT.
-                # Exceptions raised in the handler will be logged by the context
-                # manager and we will then wait for the next record.
-
-                result = handler(record.params, response.start)
-                try:
-                    for part in result:
-                        if part:
-                            response.send(FCGI_STDOUT, part)
-                finally:
-                    if hasattr(result, 'close'):
-                        result.close()
+                    threads = get_thread_count()
+                    # The settings are now in os.environ, which is not
+                    # updated again for each request
+                    _REQUEST_TEMPLATE = RequestTemplate()
+                    start_metrics()
+
+                run_handler(record, response, handler)
+
+            if threads:
+                # Later requests are multiplexed onto worker threads
+                start_workers(threads, handler)
+                threads = 0
     except _ExitException:
         pass
     except Exception:
@@ -861,6 +2601,7 @@ def main():
     finally:
         run_exit_tasks()
         maybe_log('wfastcgi.py %s closed' % __version__)
+        flush_log()
 
 def _run_appcmd(args):
     from subprocess import check_call, CalledProcessError
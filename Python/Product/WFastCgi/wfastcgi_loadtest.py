@@ -0,0 +1,412 @@
+# Python Tools for Visual Studio
+# Copyright(c) Microsoft Corporation
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the License); you may not use
+# this file except in compliance with the License. You may obtain a copy of the
+# License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# THIS CODE IS PROVIDED ON AN  *AS IS* BASIS, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, EITHER EXPRESS OR IMPLIED, INCLUDING WITHOUT LIMITATION ANY
+# IMPLIED WARRANTIES OR CONDITIONS OF TITLE, FITNESS FOR A PARTICULAR PURPOSE,
+# MERCHANTABILITY OR NON-INFRINGEMENT.
+#
+# See the Apache Version 2.0 License for specific language governing
+# permissions and limitations under the License.
+
+"""Measures the throughput of wfastcgi.py without IIS.
+
+wfastcgi.py is started in a new process and sent requests by a FastCGI client
+in this script, either over a socket passed as its stdin (as IIS does with a
+pipe) or over connections to a TCP or Unix socket using WSGI_LISTEN. One of
+the sample applications in this file handles the requests.
+
+    python wfastcgi_loadtest.py --app tiny --requests 20000 --concurrency 4
+
+The number of requests per second, latency percentiles and the memory used by
+the server processes are printed when the requests complete.
+"""
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Microsoft Corporation <ptvshelp@microsoft.com>"
+__version__ = "3.0.0"
+
+import argparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+# Sample applications
+
+def tiny_app(environ, start_response):
+    """returns a small response"""
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '12')])
+    return [b'Hello world\n']
+
+def stream_app(environ, start_response):
+    """returns chunks=N parts of size=N bytes from a generator"""
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    chunks = int(query.get('chunks', ['64'])[0])
+    size = int(query.get('size', ['16384'])[0])
+    start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    chunk = b'x' * size
+    return (chunk for _ in range(chunks))
+
+def upload_app(environ, start_response):
+    """reads the request body and returns its length"""
+    stream = environ['wsgi.input']
+    length = 0
+    while True:
+        data = stream.read(64 * 1024)
+        if not data:
+            break
+        length += len(data)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(length).encode('ascii')]
+
+_FILES = {}
+
+def file_app(environ, start_response):
+    """returns a file of size=N bytes using wsgi.file_wrapper, or by reading
+    it in 64 KB blocks when wrapper=0"""
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    size = int(query.get('size', ['1048576'])[0])
+    path = _FILES.get(size)
+    if path is None:
+        # The file is left for later runs rather than deleted, as the server
+        # is terminated without running any cleanup
+        path = os.path.join(tempfile.gettempdir(), 'wfastcgi_loadtest-%s.bin' % size)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            os.write(fd, b'x' * size)
+            os.close(fd)
+            os.rename(temp_path, path)
+        _FILES[size] = path
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'), ('Content-Length', str(size))])
+    f = open(path, 'rb')
+    if query.get('wrapper', ['1'])[0] != '0' and 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](f, 64 * 1024)
+    def read_blocks():
+        with f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                yield block
+    return read_blocks()
+
+APPS = {
+    'tiny': 'wfastcgi_loadtest.tiny_app',
+    'stream': 'wfastcgi_loadtest.stream_app',
+    'upload': 'wfastcgi_loadtest.upload_app',
+    'file': 'wfastcgi_loadtest.file_app',
+}
+
+# FastCGI client
+
+FCGI_RECORD_HEADER = struct.Struct('>BBHHBB')
+FCGI_BEGIN_REQUEST_BODY = struct.Struct('>HB5x')
+FCGI_MAX_CONTENT_LEN = 0xFFFF
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+
+def make_records(record_type, req_id, content, chunk_size=FCGI_MAX_CONTENT_LEN):
+    """returns content split into records of at most chunk_size bytes,
+    followed by an empty record"""
+    parts = []
+    for offset in range(0, len(content), chunk_size):
+        data = content[offset:offset + chunk_size]
+        parts.append(FCGI_RECORD_HEADER.pack(1, record_type, req_id, len(data), 0, 0))
+        parts.append(data)
+    parts.append(FCGI_RECORD_HEADER.pack(1, record_type, req_id, 0, 0, 0))
+    return b''.join(parts)
+
+def encode_length(length):
+    if length < 0x80:
+        return struct.pack('>B', length)
+    return struct.pack('>I', length | 0x80000000)
+
+def encode_params(params):
+    parts = []
+    for name, value in params.items():
+        name = name.encode('iso-8859-1')
+        value = value.encode('iso-8859-1')
+        parts.extend((encode_length(len(name)), encode_length(len(value)), name, value))
+    return b''.join(parts)
+
+def make_request(req_id, params, body, chunk_size):
+    """returns all the records for a request"""
+    begin = FCGI_BEGIN_REQUEST_BODY.pack(FCGI_RESPONDER, FCGI_KEEP_CONN)
+    return b''.join((
+        FCGI_RECORD_HEADER.pack(1, FCGI_BEGIN_REQUEST, req_id, len(begin), 0, 0),
+        begin,
+        make_records(FCGI_PARAMS, req_id, encode_params(params)),
+        make_records(FCGI_STDIN, req_id, body, chunk_size),
+    ))
+
+class FastCgiConnection(object):
+    """A connection to wfastcgi.py. Requests may be sent from several
+    threads, each using a different request ID, and their responses are read
+    on a background thread."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._reader = sock.makefile('rb')
+        self._send_lock = threading.Lock()
+        self._waiting = {}
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._read_responses)
+        thread.daemon = True
+        thread.start()
+
+    def request(self, req_id, data):
+        """sends the records in data and returns the status line of the
+        response and whether any errors were written"""
+        done = threading.Event()
+        result = []
+        with self._lock:
+            self._waiting[req_id] = done, result
+        with self._send_lock:
+            self.sock.sendall(data)
+        done.wait()
+        if not result:
+            raise IOError('connection closed')
+        return result[0]
+
+    def _read_responses(self):
+        read = self._reader.read
+        status = {}
+        errors = set()
+        try:
+            while True:
+                header = read(FCGI_RECORD_HEADER.size)
+                if len(header) < FCGI_RECORD_HEADER.size:
+                    break
+                _, record_type, req_id, length, padding, _ = FCGI_RECORD_HEADER.unpack(header)
+                content = read(length + padding)[:length]
+                if record_type == FCGI_STDOUT:
+                    if req_id not in status and content:
+                        status[req_id] = content.partition(b'\r\n')[0]
+                elif record_type == FCGI_STDERR:
+                    if content:
+                        errors.add(req_id)
+                elif record_type == FCGI_END_REQUEST:
+                    with self._lock:
+                        done, result = self._waiting.pop(req_id)
+                    result.append((status.pop(req_id, b''), req_id in errors))
+                    errors.discard(req_id)
+                    done.set()
+        finally:
+            with self._lock:
+                waiting, self._waiting = self._waiting, {}
+            for done, _ in waiting.values():
+                done.set()
+
+    def close(self):
+        # The reader's file object keeps the socket open, so shut it down to
+        # let the server see the connection end
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+# Server process
+
+def start_server(args):
+    """starts wfastcgi.py, returning the process and functions that open and
+    close connections to it"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['WSGI_HANDLER'] = APPS[args.app]
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (here, env.get('PYTHONPATH')) if p)
+    if args.threads:
+        env['WSGI_THREADS'] = str(args.threads)
+    if args.workers:
+        env['WSGI_PREFORK_WORKERS'] = str(args.workers)
+    if args.log:
+        env['WSGI_LOG'] = args.log
+    command = [args.python or sys.executable, os.path.join(here, 'wfastcgi.py')]
+
+    if args.mode == 'pipe':
+        # IIS provides a duplex pipe as stdin, which a socket pair emulates
+        server_end, client_end = socket.socketpair()
+        process = subprocess.Popen(command, stdin=server_end, env=env, cwd=here)
+        server_end.close()
+        connection = FastCgiConnection(client_end)
+        return process, lambda: connection, lambda connection: None
+
+    if args.mode == 'unix':
+        address = os.path.join(tempfile.mkdtemp(), 'wfastcgi.sock')
+        env['WSGI_LISTEN'] = address
+        family = socket.AF_UNIX
+    else:
+        address = ('127.0.0.1', args.port)
+        env['WSGI_LISTEN'] = '127.0.0.1:%s' % args.port
+        family = socket.AF_INET
+    with open(os.devnull, 'rb') as devnull:
+        process = subprocess.Popen(command, stdin=devnull, env=env, cwd=here)
+
+    def connect():
+        deadline = time.time() + 30
+        while True:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                return FastCgiConnection(sock)
+            except socket.error:
+                sock.close()
+                if time.time() > deadline or process.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+    # Connections are closed when finished with, as each one occupies one of
+    # the server's threads
+    return process, connect, FastCgiConnection.close
+
+def get_memory(pid):
+    """returns the resident and peak memory in kB of pid and its children"""
+    resident = peak = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open('/proc/%s/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        resident += int(line.split()[1])
+                    elif line.startswith('VmHWM:'):
+                        peak += int(line.split()[1])
+            with open('/proc/%s/task/%s/children' % (pid, pid)) as f:
+                pids.extend(f.read().split())
+        except (IOError, OSError):
+            pass
+    return resident, peak
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run(args):
+    process, connect, disconnect = start_server(args)
+    body = b'x' * args.body_size
+    params = {
+        'REQUEST_METHOD': 'POST' if body else 'GET',
+        'PATH_INFO': '/',
+        'QUERY_STRING': args.query,
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'APPL_PHYSICAL_PATH': os.path.dirname(os.path.abspath(__file__)),
+    }
+
+    try:
+        # The first request imports the application
+        started = time.time()
+        connection = connect()
+        status, _ = connection.request(1, make_request(1, params, body, args.chunk_size))
+        disconnect(connection)
+        print('First request: %s in %.1f ms' % (status.decode('ascii', 'replace'), (time.time() - started) * 1000))
+
+        latencies = []
+        failures = []
+        remaining = [args.requests]
+        lock = threading.Lock()
+
+        def client(index):
+            req_id = index + 1
+            data = make_request(req_id, params, body, args.chunk_size)
+            connection = connect()
+            times = []
+            failed = 0
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+                start = time.time()
+                status, errors = connection.request(req_id, data)
+                times.append(time.time() - start)
+                if errors or not status.startswith(b'Status: 200'):
+                    failed += 1
+            disconnect(connection)
+            with lock:
+                latencies.extend(times)
+                failures.append(failed)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        latencies.sort()
+        print('Requests:    %d in %.2f s, %d failed' % (len(latencies), elapsed, sum(failures)))
+        print('Throughput:  %.1f requests/s' % (len(latencies) / elapsed))
+        print('Latency:     p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms' % tuple(
+            percentile(latencies, f) * 1000 for f in (0.5, 0.9, 0.99, 1.0)
+        ))
+        resident, peak = get_memory(process.pid)
+        if resident:
+            print('Memory:      %d kB resident, %d kB peak' % (resident, peak))
+    finally:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the throughput of wfastcgi.py')
+    parser.add_argument('--app', choices=sorted(APPS), default='tiny',
+                        help='the sample application to run')
+    parser.add_argument('--mode', choices=('pipe', 'unix', 'tcp'), default='pipe',
+                        help='connect through stdin as IIS does, or with WSGI_LISTEN')
+    parser.add_argument('--port', type=int, default=9000,
+                        help='the port to listen on in tcp mode')
+    parser.add_argument('--requests', type=int, default=10000,
+                        help='the total number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='the number of requests to send at the same time')
+    parser.add_argument('--body-size', type=int, default=0,
+                        help='the number of bytes sent as the request body')
+    parser.add_argument('--chunk-size', type=int, default=FCGI_MAX_CONTENT_LEN,
+                        help='the largest FCGI_STDIN record to send')
+    parser.add_argument('--query', default='',
+                        help='the query string, such as chunks=64&size=16384 for the stream app, '
+                             'or size=1048576&wrapper=0 for the file app')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='WSGI_THREADS for the server')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='WSGI_PREFORK_WORKERS for the server, in unix or tcp mode')
+    parser.add_argument('--log', help='WSGI_LOG for the server')
+    parser.add_argument('--python', help='the Python interpreter to run the server with')
+    args = parser.parse_args()
+
+    if args.mode == 'pipe' and args.concurrency > 1 and args.threads < 2:
+        parser.error('requests on the pipe only run concurrently with --threads')
+    if not 0 < args.chunk_size <= FCGI_MAX_CONTENT_LEN:
+        parser.error('--chunk-size must be between 1 and %s' % FCGI_MAX_CONTENT_LEN)
+    run(args)
+
+if __name__ == '__main__':
+    main()
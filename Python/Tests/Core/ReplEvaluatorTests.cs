@@ -16,6 +16,7 @@
 
 using System;
 using System.Collections.Generic;
+using System.Diagnostics;
 using System.IO;
 using System.Linq;
 using System.Runtime.ExceptionServices;
@@ -129,6 +130,41 @@ namespace PythonToolsTests {
             }
         }
 
+        [TestMethod, Priority(UnitTestPriority.P1)]
+        public async Task BackendUnitTests() {
+            var python = PythonPaths.LatestVersion;
+            python.AssertInstalled();
+
+            // ptvsd_repl_launcher.py is installed next to the ptvsd package
+            var ptvsdRoot = Path.GetDirectoryName(PythonToolsInstallPath.GetFile(
+                "ptvsd_repl_launcher.py",
+                typeof(PythonToolsPackage).Assembly
+            ));
+            var tests = Path.Combine(
+                Path.GetDirectoryName(typeof(ReplEvaluatorTests).Assembly.Location),
+                "ptvsd_repl_tests.py"
+            );
+            Assert.IsTrue(File.Exists(tests), "Did not find " + tests);
+
+            using (var process = ProcessOutput.Run(
+                python.InterpreterPath,
+                new[] { tests, ptvsdRoot },
+                Environment.CurrentDirectory,
+                Enumerable.Empty<KeyValuePair<string, string>>(),
+                false,
+                null
+            )) {
+                var exitCode = await process;
+                foreach (var line in process.StandardErrorLines) {
+                    Trace.TraceError("STDERR: " + line);
+                }
+                foreach (var line in process.StandardOutputLines) {
+                    Trace.TraceInformation("STDOUT: " + line);
+                }
+                Assert.AreEqual(0, exitCode);
+            }
+        }
+
         [TestMethod, Priority(UnitTestPriority.P1_FAILING)]
         public void ReplSplitCodeTest() {
             // http://pytools.codeplex.com/workitem/606
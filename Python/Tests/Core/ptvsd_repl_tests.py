@@ -0,0 +1,160 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+
+# The directory containing the ptvsd package
+sys.path.insert(0, sys.argv[1])
+
+from ptvsd.repl import BasicReplBackend, jupyter_kernel_pool
+
+
+class BasicReplBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = BasicReplBackend('ptvsd_repl_tests_scope')
+        self.scope = self.backend.exec_mod.__dict__
+
+    def test_member_types_follow_rebinding(self):
+        exec('class C(object):\n    x = 1\nc = C()', self.scope)
+        _, _, type_members = self.backend.get_members('c')
+        self.assertEqual(type_members['x'], int.__module__ + '.int')
+
+        exec('C.x = "a"', self.scope)
+        _, _, type_members = self.backend.get_members('c')
+        self.assertEqual(type_members['x'], str.__module__ + '.str')
+
+        exec('del C.x\nC.y = 1.0', self.scope)
+        _, _, type_members = self.backend.get_members('c')
+        self.assertNotIn('x', type_members)
+        self.assertEqual(type_members['y'], float.__module__ + '.float')
+
+    def test_member_types_follow_base_rebinding(self):
+        exec('class B(object):\n    x = 1\nclass C(B, dict): pass\nc = C()', self.scope)
+        _, _, type_members = self.backend.get_members('c')
+        self.assertEqual(type_members['x'], int.__module__ + '.int')
+
+        exec('B.x = "a"', self.scope)
+        _, _, type_members = self.backend.get_members('c')
+        self.assertEqual(type_members['x'], str.__module__ + '.str')
+
+    def test_signature_keyword_only(self):
+        exec('def f(a, *, b=1, c): pass\ndef g(a, *args, b=1): pass', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a', '*', 'b=1', 'c'])
+        [(_, args, _, _, _)] = self.backend.get_signatures('g')
+        self.assertEqual(args, ['a', '*args', 'b=1'])
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'requires positional-only parameters')
+    def test_signature_positional_only(self):
+        exec('def f(a, b=1, /, c=2, *, d): pass\ndef g(a, /): pass', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a', 'b=1', '/', 'c=2', '*', 'd'])
+        [(_, args, _, _, _)] = self.backend.get_signatures('g')
+        self.assertEqual(args, ['a', '/'])
+        [(_, args, _, _, _)] = self.backend.get_signatures('divmod')
+        self.assertEqual(args, ['x', 'y', '/'])
+
+    def test_signature_follows_defaults(self):
+        exec('def f(a=1, *, b=2): pass\nclass C(object):\n    def m(self, a=1): pass\nc = C()', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a=1', '*', 'b=2'])
+        [(_, args, _, _, _)] = self.backend.get_signatures('c.m')
+        self.assertEqual(args, ['a=1'])
+
+        exec('f.__defaults__ = (3,)\nf.__kwdefaults__["b"] = 4\nC.m.__defaults__ = (5,)', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a=3', '*', 'b=4'])
+        [(_, args, _, _, _)] = self.backend.get_signatures('c.m')
+        self.assertEqual(args, ['a=5'])
+
+    def test_signature_follows_mutable_defaults(self):
+        exec('def f(a=[]): pass', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a=[]'])
+
+        exec('f.__defaults__[0].append(1)', self.scope)
+        [(_, args, _, _, _)] = self.backend.get_signatures('f')
+        self.assertEqual(args, ['a=[1]'])
+
+
+class FakeKernelManager(object):
+    def __init__(self):
+        self.interrupted = threading.Event()
+        self.shut_down = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_connection_info(self):
+        return {'key': b'key'}
+
+    def is_alive(self):
+        return not self.shut_down.is_set()
+
+    def interrupt_kernel(self):
+        self.interrupted.set()
+
+    def shutdown_kernel(self, now=False):
+        self.shut_down.set()
+        self.release.wait(10)
+
+
+class KernelPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        state_file = os.path.join(self.dir, 'pool.json')
+        self.state_file = jupyter_kernel_pool._state_file
+        jupyter_kernel_pool._state_file = lambda: state_file
+
+        # a size of 0 stops the pool from starting real kernels
+        self.pool = jupyter_kernel_pool.KernelPool(state_file, 0)
+        self.pool.poll_interval = 0.05
+        self.km = FakeKernelManager()
+        self.pool.ready.append(jupyter_kernel_pool.PooledKernel(self.km))
+        self.thread = threading.Thread(target=self.pool.serve)
+        self.thread.start()
+        deadline = time.time() + 10
+        while not os.path.exists(state_file) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.pool.idle_timeout = 0
+        self.thread.join(10)
+        jupyter_kernel_pool._state_file = self.state_file
+        shutil.rmtree(self.dir)
+
+    def test_interrupt_keeps_claimed_kernel(self):
+        claim = jupyter_kernel_pool.claim_kernel(1)
+        self.assertIsNotNone(claim)
+        try:
+            claim.interrupt()
+            self.assertTrue(self.km.interrupted.wait(10))
+            self.assertFalse(self.km.shut_down.is_set())
+        finally:
+            claim.close()
+        self.assertTrue(self.km.shut_down.wait(10))
+
+    def test_close_does_not_wait_for_shutdown(self):
+        km2 = FakeKernelManager()
+        self.pool.ready.append(jupyter_kernel_pool.PooledKernel(km2))
+        self.km.release.clear()
+        try:
+            claim = jupyter_kernel_pool.claim_kernel(1)
+            self.assertIsNotNone(claim)
+            claim.close()
+            self.assertTrue(self.km.shut_down.wait(10))
+
+            # the pool keeps serving while the first kernel shuts down
+            claim = jupyter_kernel_pool.claim_kernel(1)
+            self.assertIsNotNone(claim)
+            claim.close()
+            self.assertTrue(km2.shut_down.wait(10))
+        finally:
+            self.km.release.set()
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])
@@ -66,6 +66,28 @@ namespace FastCgiTests {
             }
         }
 
+        [TestMethod, Priority(UnitTestPriority.P1)]
+        public void WFastCgiUnitTests() {
+            var tests = Path.Combine(
+                Path.GetDirectoryName(typeof(FastCgiTests2x).Assembly.Location),
+                "wfastcgi_tests.py"
+            );
+            Assert.IsTrue(File.Exists(tests), "Did not find " + tests);
+
+            using (var p = ProcessOutput.Run(
+                InterpreterPath,
+                new[] { tests, WFastCgiPath },
+                Environment.CurrentDirectory,
+                Enumerable.Empty<KeyValuePair<string, string>>(),
+                false,
+                null
+            )) {
+                p.Wait();
+                DumpOutput(p);
+                Assert.AreEqual(0, p.ExitCode);
+            }
+        }
+
         [TestMethod, Priority(UnitTestPriority.P1_FAILING)]
         [TestCategory("10s")]
         public void DjangoHelloWorld() {
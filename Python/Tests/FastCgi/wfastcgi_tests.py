@@ -0,0 +1,390 @@
+import os
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+# The path to wfastcgi.py
+WFASTCGI_PATH = os.path.abspath(sys.argv[1])
+sys.path.insert(0, os.path.dirname(WFASTCGI_PATH))
+
+import wfastcgi
+
+TEST_APP = textwrap.dedent('''
+    import sys
+    import time
+
+    kept_output = []
+
+    def app(environ, start_response):
+        path = environ['PATH_INFO']
+        body = environ['wsgi.input']
+        if path == '/keep-output':
+            kept_output.append(sys.stdout)
+            out = b'kept'
+        elif path == '/use-kept-output':
+            kept_output[0].write('from an earlier request')
+            print('from this request')
+            raise Exception('fail')
+        elif path == '/slow':
+            time.sleep(1.5)
+            out = b'slept'
+        elif path == '/partial':
+            out = body.read(5)
+        elif path == '/seek':
+            first = body.read()
+            body.seek(0)
+            out = ('%d %r ' % (len(first), body._spool._rolled)).encode('ascii') + body.read(10)
+        elif path == '/echo':
+            out = body.read()
+        else:
+            out = b'ignored'
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [out]
+''')
+
+
+def record(reqtype, req_id, content=b''):
+    return wfastcgi.FCGI_RECORD_HEADER.pack(
+        wfastcgi.FCGI_VERSION_1, reqtype, req_id, len(content), 0, 0
+    ) + content
+
+
+@unittest.skipUnless(os.name == 'posix', 'wfastcgi can only be given a socket on POSIX')
+class WFastCgiProcessTests(unittest.TestCase):
+    """runs wfastcgi.py with a socket for stdin, which is how IIS connects to
+    it with a pipe"""
+
+    settings = {}
+    # appSettings written to Web.config
+    app_settings = {}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'testapp.py'), 'w') as f:
+            f.write(TEST_APP)
+        if self.app_settings:
+            with open(os.path.join(self.dir, 'Web.config'), 'w') as f:
+                f.write('<configuration><appSettings>')
+                for item in self.app_settings.items():
+                    f.write('<add key="%s" value="%s" />' % item)
+                f.write('</appSettings></configuration>')
+
+        env = dict(os.environ, WSGI_HANDLER='testapp.app')
+        env.update(self.settings)
+        self.sock, child = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, WFASTCGI_PATH],
+            stdin=child,
+            env=env,
+            cwd=self.dir,
+        )
+        child.close()
+        self.received = b''
+
+    def tearDown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.process.wait()
+        self.sock.close()
+        shutil.rmtree(self.dir)
+
+    def begin_request(self, req_id, path):
+        params = {
+            'APPL_PHYSICAL_PATH': self.dir,
+            'PATH_INFO': path,
+            'REQUEST_METHOD': 'POST',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+        }
+        self.sock.sendall(
+            record(wfastcgi.FCGI_BEGIN_REQUEST, req_id, struct.pack('>HB5x', wfastcgi.FCGI_RESPONDER, wfastcgi.FCGI_KEEP_CONN)) +
+            record(wfastcgi.FCGI_PARAMS, req_id, wfastcgi.write_fastcgi_keyvalue_pairs(params)) +
+            record(wfastcgi.FCGI_PARAMS, req_id)
+        )
+
+    def send_input(self, req_id, data, end=True):
+        chunks = [record(wfastcgi.FCGI_STDIN, req_id, data[i:i + 8192]) for i in range(0, len(data), 8192)]
+        if end:
+            chunks.append(record(wfastcgi.FCGI_STDIN, req_id))
+        self.sock.sendall(b''.join(chunks))
+
+    def _recv(self, count):
+        while len(self.received) < count:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError()
+            self.received += data
+        res, self.received = self.received[:count], self.received[count:]
+        return res
+
+    def has_response(self, timeout):
+        return bool(self.received) or bool(select.select([self.sock], [], [], timeout)[0])
+
+    def read_responses(self, count, timeout=10):
+        """returns the content of FCGI_STDOUT for count requests by request
+        ID, or the FCGI_END_REQUEST body for those that were refused"""
+        self.sock.settimeout(timeout)
+        stdout = {}
+        responses = {}
+        self.stderr = b''
+        while len(responses) < count:
+            _, reqtype, req_id, size, padding, _ = wfastcgi.FCGI_RECORD_HEADER.unpack(self._recv(wfastcgi.FCGI_HEADER_LEN))
+            content = self._recv(size + padding)[:size]
+            if reqtype == wfastcgi.FCGI_STDOUT:
+                stdout[req_id] = stdout.get(req_id, b'') + content
+            elif reqtype == wfastcgi.FCGI_STDERR:
+                self.stderr += content
+            elif reqtype == wfastcgi.FCGI_END_REQUEST:
+                if req_id in stdout:
+                    responses[req_id] = stdout.pop(req_id).partition(b'\r\n\r\n')[2]
+                else:
+                    responses[req_id] = content
+        return responses
+
+    def read_response(self, timeout=10):
+        return list(self.read_responses(1, timeout).values())[0]
+
+    def wait_for_exit(self, timeout=10):
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        return self.process.poll()
+
+    def request(self, path, data=b'', req_id=1):
+        self.begin_request(req_id, path)
+        self.send_input(req_id, data)
+        return self.read_response()
+
+
+class BufferedInputTests(WFastCgiProcessTests):
+    def test_waits_for_body(self):
+        self.begin_request(1, '/ignore')
+        self.send_input(1, b'hello', end=False)
+        self.assertFalse(self.has_response(0.5))
+        self.send_input(1, b' world')
+        self.assertEqual(self.read_response(), b'ignored')
+        self.assertEqual(self.request('/echo', b'hello world'), b'hello world')
+
+
+class OutputCaptureTests(WFastCgiProcessTests):
+    def test_output_kept_after_request(self):
+        self.assertEqual(self.request('/keep-output'), b'kept')
+        self.request('/use-kept-output')
+        self.assertIn(b'from this request', self.stderr)
+        self.assertNotIn(b'from an earlier request', self.stderr)
+
+
+class DrainTestsBase(WFastCgiProcessTests):
+    app_settings = {
+        'WSGI_THREADS': '2',
+        'WSGI_RESTART_FILE_REGEX': '.*\\.trigger$',
+        'WSGI_RESTART_DEBOUNCE': '0.1',
+    }
+
+    def drain(self):
+        """starts a slow request, then changes a file while it runs and
+        begins another request once the process is restarting"""
+        # The first request starts the file watcher and worker threads
+        self.assertEqual(self.request('/echo', b'first'), b'first')
+        time.sleep(0.2)
+
+        self.begin_request(1, '/slow')
+        self.send_input(1, b'')
+        open(os.path.join(self.dir, 'restart.trigger'), 'w').close()
+        time.sleep(0.8)
+        self.begin_request(2, '/echo')
+        self.send_input(2, b'second')
+        return self.read_responses(2)
+
+
+class DrainTests(DrainTestsBase):
+    def test_runs_requests_while_draining(self):
+        self.assertEqual(self.drain(), {1: b'slept', 2: b'second'})
+        self.assertEqual(self.wait_for_exit(), 0)
+
+
+class RefusingDrainTests(DrainTestsBase):
+    app_settings = dict(DrainTestsBase.app_settings, WSGI_RESTART_REFUSE_REQUESTS='1')
+
+    def test_refuses_requests_while_draining(self):
+        self.assertEqual(self.drain(), {
+            1: b'slept',
+            2: wfastcgi.FCGI_END_REQUEST_BODY.pack(0, wfastcgi.FCGI_OVERLOADED),
+        })
+        self.assertEqual(self.wait_for_exit(), 0)
+
+
+class StreamedInputTests(WFastCgiProcessTests):
+    settings = {'WSGI_STREAM_INPUT': '1', 'WSGI_INPUT_SPOOL_SIZE': '1024'}
+
+    def test_partial_read(self):
+        self.begin_request(1, '/partial')
+        # The application only needs the first record to respond
+        self.send_input(1, b'hello', end=False)
+        self.assertEqual(self.read_response(), b'hello')
+        self.send_input(1, b' world')
+        self.assertEqual(self.request('/echo', b'next'), b'next')
+
+    def test_seek_after_spooling(self):
+        data = b''.join(b'%06d' % i for i in range(20000))
+        self.assertEqual(self.request('/seek', data), b'120000 True 0000000000')
+
+    def test_returns_without_reading_body(self):
+        self.begin_request(1, '/ignore')
+        self.assertEqual(self.read_response(), b'ignored')
+        # The rest of the body is discarded
+        self.send_input(1, b'x' * 100000)
+        self.assertEqual(self.request('/echo', b'next'), b'next')
+
+
+class FakeWatcher(object):
+    """a native file watcher that reports the changes it is given, or fails
+    when it is given an exception"""
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def changes(self):
+        while True:
+            change = self.queue.get()
+            if isinstance(change, Exception):
+                raise change
+            yield change
+
+
+class FileWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('app.py', 'a')
+        self.watcher = FakeWatcher()
+        self.create_file_watcher = wfastcgi.create_file_watcher
+        wfastcgi.create_file_watcher = lambda path, restart: self.watcher
+
+    def tearDown(self):
+        wfastcgi.create_file_watcher = self.create_file_watcher
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(content)
+
+    def start(self, debounce):
+        """starts watching, returning a queue that receives the time and
+        reason of the restart"""
+        restarts = Queue()
+        wfastcgi.start_file_watcher(
+            self.dir,
+            '.*\\.py$',
+            debounce,
+            on_change=lambda reason: restarts.put((time.time(), reason)),
+        )
+        # Let the watcher take its snapshot of the files
+        time.sleep(0.2)
+        return restarts
+
+    def test_debounce_coalesces_changes(self):
+        restarts = self.start(0.3)
+        for i in range(10):
+            self.watcher.queue.put('app%d.py' % i)
+            time.sleep(0.05)
+        last_change = time.time()
+        restarted, reason = restarts.get(timeout=10)
+        self.assertIn('app0.py', reason)
+        self.assertGreaterEqual(restarted, last_change + 0.2)
+
+    def test_debounce_max_delay(self):
+        restarts = self.start(0.1)
+        first_change = time.time()
+        # Changes keep arriving faster than the debounce time
+        while time.time() < first_change + 5 and restarts.empty():
+            self.watcher.queue.put('app.py')
+            time.sleep(0.02)
+        restarted, _ = restarts.get(timeout=10)
+        self.assertLess(restarted - first_change, 2.5)
+
+    def test_ignores_unmatched_files(self):
+        restarts = self.start(0.1)
+        self.watcher.queue.put('app.txt')
+        self.assertRaises(Empty, restarts.get, timeout=0.5)
+
+    def test_overflow_rescans(self):
+        restarts = self.start(0.1)
+        # Nothing has changed, so the rescan does not restart
+        self.watcher.queue.put('')
+        self.assertRaises(Empty, restarts.get, timeout=0.5)
+
+        self.write('app.py', 'changed')
+        self.watcher.queue.put('')
+        _, reason = restarts.get(timeout=10)
+        self.assertIn('app.py', reason)
+
+    def test_polling_fallback(self):
+        restarts = self.start(0.1)
+        self.watcher.queue.put(OSError('watcher failed'))
+        # Let the polling watcher take its snapshot of the files
+        time.sleep(0.5)
+        self.write('app.py', 'changed')
+        _, reason = restarts.get(timeout=10)
+        self.assertIn('app.py', reason)
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'requires inotify')
+class InotifyFileWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'app.py'), 'w') as f:
+            f.write('a')
+        self.watcher = wfastcgi.InotifyFileWatcher(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def collect_changes(self):
+        changes = Queue()
+
+        def collect():
+            for change in self.watcher.changes():
+                changes.put(change)
+
+        t = threading.Thread(target=collect)
+        t.daemon = True
+        t.start()
+        return changes
+
+    def test_moved_from(self):
+        changes = self.collect_changes()
+        os.rename(os.path.join(self.dir, 'app.py'), os.path.join(self.dir, 'app.bak'))
+        seen = set()
+        while not set(['app.py', 'app.bak']) <= seen:
+            seen.add(changes.get(timeout=10))
+
+    def test_overflow(self):
+        # Replace the inotify descriptor with a pipe that reports an overflow
+        os.close(self.watcher.fd)
+        self.watcher.fd, write_fd = os.pipe()
+        os.write(write_fd, wfastcgi.INOTIFY_EVENT.pack(-1, wfastcgi.IN_Q_OVERFLOW, 0, 0))
+        os.close(write_fd)
+        changes = self.watcher.changes()
+        self.assertEqual(next(changes), '')
+        changes.close()
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv[:1])